@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+"""
+Load test for playon_api_and_mcp.py against a stand-in PlayOn server.
+
+Starts a fake PlayOn server on 127.0.0.1:54479 and the API in a subprocess (or uses --target),
+then fires a weighted mix of /search, /providers and /mcp requests at a fixed arrival rate and
+reports throughput, latency percentiles, error rate and event loop lag. Results are written as
+JSON so runs can be diffed.
+
+    python load_test.py --rate 20 --duration 30 --mix search=3,providers=1,mcp_call=3,mcp_rpc=1,mcp_session=2
+"""
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+import threading
+import subprocess
+from pathlib import Path
+from datetime import datetime
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from xml.sax.saxutils import quoteattr
+
+import httpx
+
+TITLES = ['Bluey', 'Doctor Who', 'The Office', 'Planet Earth', 'Top Gear', 'Star Trek',
+          'Great British Bake Off', 'Mythbusters', 'Frasier', 'Columbo', 'Nova', 'Cosmos']
+
+
+# Stand-in PlayOn server
+class FakePlayOnHandler(BaseHTTPRequestHandler):
+    """
+    Serves a deterministic catalog shaped like PlayOn's data.xml: providers, search results
+    (a mix of show folders and movie videos), seasons and episodes
+    """
+    providers = 5
+    latency = 0.0
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        query = parse_qs(urlsplit(self.path).query)
+        provider = query.get('id', [None])[0]
+        if urlsplit(self.path).path != '/data/data.xml':
+            self.send_xml('<group/>', status=404)
+        elif provider is None:
+            self.send_xml(''.join(f'<group id="p{i}" name="Provider {i}" href="/data/data.xml?id=p{i}"/>'
+                                  for i in range(self.providers)))
+        elif 'searchterm' in query:
+            self.send_xml(self.search(provider, query['searchterm'][0]))
+        else:
+            self.send_xml(self.folder(provider))
+
+    def search(self, provider, search_term):
+        seed = int(hashlib.md5(f"{provider}{search_term}".encode()).hexdigest(), 16)
+        groups = [f'<group id="{provider}" name="Provider" href="/data/data.xml?id={provider}"/>']
+        for n in range(seed % 6):
+            name = quoteattr(f"{search_term} {n}" if n else search_term)
+            if (seed >> n) & 1:
+                groups.append(f'<group name={name} type="folder" childs="3" '
+                              f'href="/data/data.xml?id={provider}-s{seed % 1000}-{n}"/>')
+            else:
+                groups.append(f'<group name={name} type="video" href="/data/data.xml?id={provider}-v{seed % 1000}-{n}"/>')
+        return ''.join(groups)
+
+    def folder(self, folder_id):
+        # Shows have three seasons of eight episodes
+        if folder_id.count('-') == 2:
+            return ''.join(f'<group name="Season {s}" type="folder" childs="8" href="/data/data.xml?id={folder_id}-{s}"/>'
+                           for s in range(1, 4))
+        return ''.join(f'<group name="Episode {e}" type="video" href="/data/data.xml?id={folder_id}-e{e}"/>'
+                       for e in range(1, 9))
+
+    def send_xml(self, groups, status=200):
+        body = f'<?xml version="1.0"?><catalog>{groups}</catalog>'.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_playon(host, providers, latency_ms):
+    FakePlayOnHandler.providers = providers
+    FakePlayOnHandler.latency = latency_ms / 1000
+    # The API always talks to port 54479 on whatever server it's given
+    server = ThreadingHTTPServer((host, 54479), FakePlayOnHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_api(port, workers):
+    api = subprocess.Popen([sys.executable, str(Path(__file__).parent / 'playon_api_and_mcp.py'),
+                            '--host', '127.0.0.1', '--port', str(port), '--workers', str(workers)],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/health", timeout=1).status_code == 200:
+                return api
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    api.kill()
+    sys.exit("API didn't come up within 30s")
+
+
+# Request mix
+def rpc(method, params=None):
+    return {"jsonrpc": "2.0", "id": random.randint(1, 1 << 30), "method": method, "params": params or {}}
+
+
+async def do_search(client, upstream):
+    return [await client.get("/search", params={"search_term": random.choice(TITLES), "server": upstream,
+                                                 "media_type": random.choice(["show", "movie"])})]
+
+
+async def do_providers(client, upstream):
+    return [await client.get("/providers", params={"server": upstream})]
+
+
+async def do_mcp_call(client, upstream):
+    arguments = {"search_term": random.choice(TITLES), "server": upstream}
+    return [await client.post("/mcp", json=rpc("tools/call", {"name": "search_media", "arguments": arguments}))]
+
+
+async def do_mcp_rpc(client, upstream):
+    return [await client.post("/mcp", json=rpc(random.choice(["initialize", "tools/list", "ping"])))]
+
+
+async def do_mcp_session(client, upstream):
+    """A whole streamable HTTP session: initialize, search, trace the first hit by name, close"""
+    responses = [await client.post("/mcp", json=rpc("initialize"))]
+    session_id = responses[0].headers.get("mcp-session-id")
+    headers = {"Mcp-Session-Id": session_id} if session_id else {}
+    responses.append(await client.post("/mcp", headers=headers, json=rpc("tools/call", {
+        "name": "search_media", "arguments": {"search_term": random.choice(TITLES), "server": upstream}})))
+    if not session_id:
+        # The API runs sessions only with a single worker, there's nothing to trace by name or close
+        return responses
+    text = responses[-1].json().get("result", {}).get("content", [{}])[0].get("text", "")
+    folder = re.search(r"^• (.+) \(folder\) - ", text, re.MULTILINE)
+    if folder:
+        responses.append(await client.post("/mcp", headers=headers, json=rpc("tools/call", {
+            "name": "trace_media_folder", "arguments": {"name": folder.group(1), "server": upstream, "limit": 20}})))
+    responses.append(await client.delete("/mcp", headers=headers))
+    return responses
+
+
+SCENARIOS = {
+    "search": do_search,
+    "providers": do_providers,
+    "mcp_call": do_mcp_call,
+    "mcp_rpc": do_mcp_rpc,
+    "mcp_session": do_mcp_session,
+}
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            sys.exit(f"Unknown scenario '{name}', pick from {', '.join(SCENARIOS)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def is_error(response):
+    # A 404 on DELETE /mcp means the session was lost, which is exactly what the session scenario checks
+    if response.status_code >= 400:
+        return True
+    # JSON-RPC and tool errors come back as 200
+    if response.request.url.path == "/mcp" and response.content:
+        body = response.json()
+        return "error" in body or bool(body.get("result", {}).get("isError"))
+    return False
+
+
+# Measurement
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def summarize(samples, elapsed):
+    latencies = [sample['latency'] for sample in samples]
+    errors = sum(1 for sample in samples if sample['error'])
+    return {
+        "requests": len(samples),
+        "throughput_rps": round(len(samples) / elapsed, 2) if elapsed else 0,
+        "error_rate": round(errors / len(samples), 4) if samples else 0,
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        "max_ms": round(max(latencies) * 1000, 2) if latencies else None,
+    }
+
+
+async def measure_client_lag(lags, stop):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(0.05)
+        lags.append(loop.time() - started - 0.05)
+
+
+async def run_load(args, weights):
+    samples = []
+    client_lags = []
+    stop = asyncio.Event()
+    in_flight = asyncio.Semaphore(args.max_in_flight)
+    names, cumulative = list(weights), list(weights.values())
+    limits = httpx.Limits(max_connections=args.max_in_flight, max_keepalive_connections=args.max_in_flight)
+
+    async with httpx.AsyncClient(base_url=args.target, timeout=args.timeout, limits=limits) as client:
+        async def one(name, scheduled):
+            async with in_flight:
+                error = None
+                try:
+                    responses = await SCENARIOS[name](client, args.upstream)
+                    error = next((f"HTTP {r.status_code} {r.request.url.path}" for r in responses if is_error(r)), None)
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+            # Latency counts from when the request was due, so a backed-up client doesn't hide server stalls
+            samples.append({"scenario": name, "latency": time.monotonic() - scheduled, "error": error})
+
+        lag_task = asyncio.create_task(measure_client_lag(client_lags, stop))
+        started = time.monotonic()
+        tasks = []
+        for n in range(int(args.rate * args.duration)):
+            scheduled = started + n / args.rate
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(one(random.choices(names, cumulative)[0], scheduled)))
+        await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - started
+        stop.set()
+        await lag_task
+    return samples, elapsed, client_lags
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the PlayOn API/MCP server against a fake PlayOn server")
+    parser.add_argument("--rate", type=float, default=10, help="requests started per second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to generate load for")
+    parser.add_argument("--mix", default="search=3,providers=1,mcp_call=3,mcp_rpc=1,mcp_session=2",
+                        help="scenario=weight pairs, from: " + ", ".join(SCENARIOS))
+    parser.add_argument("--max-in-flight", type=int, default=200, help="client side cap on concurrent requests")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--target", default=None, help="URL of an already running API, otherwise one is started")
+    parser.add_argument("--port", type=int, default=8011, help="port for the API started by the harness")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers for the API started by the harness")
+    parser.add_argument("--upstream", default="127.0.0.1", help="server the API is told to query")
+    parser.add_argument("--no-fake-upstream", action="store_true", default=False,
+                        help="don't start the stand-in PlayOn server (use a real one at --upstream)")
+    parser.add_argument("--providers", type=int, default=5, help="providers the stand-in server reports")
+    parser.add_argument("--upstream-latency-ms", type=float, default=20, help="delay per stand-in server response")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", default=None, help="results file (default load_results/<timestamp>.json)")
+    args = parser.parse_args()
+
+    weights = parse_mix(args.mix)
+    random.seed(args.seed)
+    fake = None if args.no_fake_upstream else start_fake_playon(args.upstream, args.providers, args.upstream_latency_ms)
+    api = None
+    if args.target is None:
+        api = start_api(args.port, args.workers)
+        args.target = f"http://127.0.0.1:{args.port}"
+
+    try:
+        started_at = time.time()
+        print(f"Running {args.rate}/s for {args.duration}s against {args.target} ({args.mix})", file=sys.stderr)
+        samples, elapsed, client_lags = asyncio.run(run_load(args, weights))
+        try:
+            server_lag = httpx.get(f"{args.target}/debug/loop", params={"since": started_at}, timeout=10).json()
+            if args.workers > 1:
+                server_lag["note"] = "sampled from whichever worker answered"
+        except (httpx.HTTPError, ValueError) as e:
+            server_lag = {"error": str(e)}
+    finally:
+        if api is not None:
+            api.terminate()
+            try:
+                api.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                # Workers wait for requests still queued for the upstream before they exit
+                api.kill()
+                api.wait()
+        if fake is not None:
+            fake.shutdown()
+
+    results = {
+        "started": datetime.fromtimestamp(started_at).isoformat(timespec='seconds'),
+        "config": {k: v for k, v in vars(args).items() if k != 'output'},
+        "overall": summarize(samples, elapsed),
+        "scenarios": {name: summarize([s for s in samples if s['scenario'] == name], elapsed) for name in weights},
+        "server_loop_lag": server_lag,
+        "client_loop_lag_p99_ms": round(percentile(client_lags, 99) * 1000, 2) if client_lags else None,
+        "sample_errors": sorted({s['error'] for s in samples if s['error']})[:20],
+    }
+
+    output = Path(args.output or Path(__file__).parent / 'load_results' / f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    overall = results['overall']
+    print(f"{overall['requests']} requests, {overall['throughput_rps']}/s, p50 {overall['p50_ms']}ms, "
+          f"p99 {overall['p99_ms']}ms, errors {overall['error_rate']:.1%}, "
+          f"server loop lag p99 {server_lag.get('p99_ms')}ms", file=sys.stderr)
+    print(json.dumps(results, indent=2))
+    print(f"Results written to {output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,17 @@
 #!/usr/bin/env python
+import os
 import re
 import json
+import time
+import threading
 import mechanize
 import xml.etree.ElementTree as ET
 from pathlib import Path
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from playon_tracing import traced
+from playon_upstream import upstream_cache, upstream_priority, open_url, scheduler
 
 def load_config():
     config_path = Path(__file__).parent / 'config.json'
@@ -29,13 +37,7 @@ def load_config():
 config = load_config()
 base_url = config['server']['base_url']
 
-def get_providers(server=None):
-    if server is None:
-        server = config['server']['ip']
-    br = mechanize.Browser()
-    br.set_handle_robots(False)
-    response = br.open(f"{base_url}/data/data.xml")
-    page_source = response.read()
+def parse_providers(page_source):
     # Use BeautifulSoup for parsing
     #soup = BeautifulSoup(page_source, 'xml.parser')
     #print(soup.findall('group', href_='/data/data.xml?id='))
@@ -47,6 +49,15 @@ def get_providers(server=None):
             providers[group.get('name')] = {'href':group.get('href'), 'id':group.get('id')}
     return providers
 
+@traced('get_providers', 'server')
+def get_providers(server=None):
+    if server is None:
+        server = config['server']['ip']
+    br = mechanize.Browser()
+    br.set_handle_robots(False)
+    return dict(upstream_cache.fetch(br, f"{base_url}/data/data.xml", parse_providers))
+
+@traced('query_provider', 'provider', 'search_term')
 def query_provider(provider, search_term, server=None):
     if server is None:
         server = config['server']['ip']
@@ -54,10 +65,9 @@ def query_provider(provider, search_term, server=None):
     br.set_handle_robots(False)
     url = f"{base_url}/data/data.xml?id={provider}&searchterm={search_term}"
     print(url)
-    results = []
-    try:
-        response = br.open(url)
-        page_source = response.read()
+
+    def parse(page_source):
+        results = []
         root = ET.fromstring(page_source)
         for ea_result in root.findall('group'):
             if 'id' in ea_result:
@@ -66,10 +76,21 @@ def query_provider(provider, search_term, server=None):
             else:
                 results.append({'href':ea_result.get('href'), 'name':ea_result.get('name'), 'provider':provider, 'type':ea_result.get('type')})
                 #print(f"{ea_result.get('name')} - {ea_result.get('type')} - {ea_result.get('href')}")
+        return results
+
+    results = []
+    try:
+        results = upstream_cache.fetch(br, url, parse)
     except Exception as e:
         print(e)
     return results
 
+def parse_folder(page_source):
+    page_source = re.sub(r'^[^<]+','',page_source.decode('utf-8', errors='ignore'))
+    root = ET.fromstring(page_source)
+    return [dict(ea_result.attrib) for ea_result in root.findall('group')]
+
+@traced('trace_folder', 'result')
 def trace_folder(result, server=None):
     if server is None:
         server = config['server']['ip']
@@ -79,11 +100,11 @@ def trace_folder(result, server=None):
     #print(url)
     search_results = []
     try:
-        response = br.open(url)
-        page_source = re.sub(r'^[^<]+','',response.read().decode('utf-8', errors='ignore'))
-        root = ET.fromstring(page_source)
+        # Unchanged folders come back from the cache without re-parsing, but subfolders are
+        # still revalidated one by one since a new episode only shows up in its season folder
+        groups = upstream_cache.fetch(br, url, parse_folder)
         groups_found = 0
-        for ea_result in root.findall('group'):
+        for ea_result in groups:
             if ea_result.get('href') == result['href']:
                 continue # This means it's the same page we're looking at
             elif ea_result.get('childs', None) is not None:
@@ -95,7 +116,6 @@ def trace_folder(result, server=None):
             groups_found += 1
         #print(groups_found)
         if groups_found == 0:
-            #print(root.findall('.//'))
             return [result]
     except Exception as e:
         print(e)
@@ -127,44 +147,281 @@ def single_match(result, pattern, media_type, server=None):
         #print(f"{result['name']} doesn't match {pattern}")
         return False
 
-def filter_results(results, search_term, media_type, match_type):
+def match_pattern(search_term, match_type='partial'):
+    # Titles like "C++" or "Who?" are matched literally, not as regular expressions
+    if match_type == 'exact':
+        return re.compile("^%s$" % re.escape(search_term), re.IGNORECASE)
+    return re.compile(".*" + re.escape(search_term), re.IGNORECASE)
+
+@traced('filter_results', 'search_term', 'media_type')
+def filter_results(results, search_term, media_type, match_type, server=None):
     # Set pattern for title matching
     #print(f"Matching pattern: {search_term}")
-    pattern = re.compile(".*" + search_term, re.IGNORECASE)
-    if match_type == 'exact':
-        pattern = re.compile("^%s$" % search_term, re.IGNORECASE)
+    pattern = match_pattern(search_term, match_type)
 
     filtered_results = []
     for result in results:
         #print(f"Checking {result['name']}")
-        if single_match(result, pattern, media_type):
+        if single_match(result, pattern, media_type, server):
             filtered_results.append(result)
             #print(f"\t{result['name']} MATCHES!")
 
 
     return filtered_results
 
+def batch_search(search_terms, media_type, match_type, excluded_providers, jobs, out, log):
+    """
+    Search every term in every provider with up to jobs (term, provider) lookups in flight, writing
+    each match to out as a JSON line as soon as it's found. Progress and timings go to log.
+    Returns the number of results written.
+    """
+    started = time.time()
+    providers = {name: info for name, info in get_providers().items() if name not in excluded_providers}
+    out_lock = threading.Lock()
+    pending = {term: len(providers) for term in search_terms}
+    found = {term: 0 for term in search_terms}
+    term_started = {}
+    stop = threading.Event()
+
+    def emit(line):
+        with out_lock:
+            out.write(line + '\n')
+            out.flush()
+
+    def lookup(search_term, provider_name):
+        if stop.is_set():
+            return
+        term_started.setdefault(search_term, time.time())
+        pattern = match_pattern(search_term, match_type)
+        url_search_term = '%20'.join(search_term.split())
+        for result in query_provider(providers[provider_name]['id'], url_search_term):
+            if stop.is_set():
+                return
+            if single_match(result, pattern, media_type):
+                try:
+                    emit(json.dumps({'search_term': search_term, 'provider_name': provider_name, **result}))
+                except BrokenPipeError:
+                    # Whoever we're piped into has stopped reading, e.g. | head
+                    stop.set()
+                    return
+                with out_lock:
+                    found[search_term] += 1
+
+    done = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(lookup, term, name): term for term in search_terms for name in providers}
+        for future in as_completed(futures):
+            term = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error searching {term}: {e}", file=log)
+            pending[term] -= 1
+            if pending[term] == 0:
+                done += 1
+                print(f"[{done}/{len(search_terms)}] {term}: {found[term]} results in "
+                      f"{time.time() - term_started.get(term, started):.2f}s", file=log)
+            if stop.is_set():
+                executor.shutdown(wait=False, cancel_futures=True)
+                break
+
+    total = sum(found.values())
+    print(f"{total} results for {len(search_terms)} search terms across {len(providers)} providers "
+          f"in {time.time() - started:.2f}s", file=log)
+    return total
+
+def queue_episode(link, server=None, br=None):
+    if server is None:
+        server = config['server']['ip']
+    if br is None:
+        br = mechanize.Browser()
+        br.set_handle_robots(False)
+    url = f"http://{server}:54479{link.get('href')}"
+    try:
+        page_source, _ = open_url(br, url)
+        root = ET.fromstring(page_source)
+        for ea_result in root.findall('media_playlater'):
+            page_source, _ = open_url(br, ea_result.get('src'))
+            #print(page_source)
+        return True
+    except Exception as e:
+        print(e)
+        return False
+
+@traced('add_to_record', 'result')
 def add_to_record(result, server=None):
     if server is None:
         server = config['server']['ip']
-    final_links = trace_folder(result=result, server=server)
+    with upstream_priority('record'):
+        final_links = trace_folder(result=result, server=server)
+        br = mechanize.Browser()
+        br.set_handle_robots(False)
+        for ea_link in final_links:
+            #print(ea_link)
+            queue_episode(ea_link, server, br)
+
+def load_watch_state(state_path):
+    try:
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        state = {}
+    state.setdefault('terms', {})
+    state.setdefault('series', {})
+    for search_term, entry in state['terms'].items():
+        if isinstance(entry, list):
+            # Older state files only kept the series hrefs
+            state['terms'][search_term] = {'series': entry, 'last_discovered': 0}
+    return state
+
+def save_watch_state(state, state_path):
+    # Write to a temp file first so a crash mid-write doesn't lose what we've already queued
+    tmp_path = Path(f"{state_path}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    tmp_path.replace(state_path)
+
+def discover_series(search_term, media_type, match_type, excluded_providers, server=None,
+                    over_budget=None, searched=None):
+    """
+    Returns the matching series across providers and whether every provider got searched.
+    Providers already in searched are skipped and the ones searched now are added to it, and
+    once over_budget() says the cycle has used up its requests it stops between providers
+    (after searching at least one, so a small budget still makes progress)
+    """
+    if searched is None:
+        searched = set()
+    providers = get_providers(server)
+    found = []
+    progressed = False
+    for ea_provider in providers:
+        if ea_provider in excluded_providers or ea_provider in searched:
+            continue
+        if progressed and over_budget is not None and over_budget():
+            return found, False
+        url_search_term = '%20'.join(search_term.split())
+        results = query_provider(providers[ea_provider]['id'], url_search_term, server)
+        found.extend(filter_results(results, search_term, media_type, match_type, server))
+        searched.add(ea_provider)
+        progressed = True
+    return found, True
+
+def upstream_requests():
+    return sum(stats['started'] for stats in scheduler.metrics()['classes'].values())
+
+def watch_cycle(search_terms, state, media_type='show', match_type='partial', excluded_providers=(),
+                budget=50, skip_existing=False, retry_empty=3600, rediscover=86400, server=None):
+    """
+    Run one auto-record pass and return a report dict.
+
+    Search terms are sent to the providers when first seen, again every rediscover seconds to pick
+    up series that appear on other providers, and every retry_empty seconds while they have no
+    series yet (not aired, or the provider lookup failed). In between, the series hrefs stored in
+    state are re-traced directly.
+
+    Discoveries and series checks are done oldest first until budget upstream requests have been
+    made this cycle, the rest wait for the next cycle. A discovery that runs out of budget stops
+    between providers and carries on from the next provider in a later cycle. Episodes that didn't
+    get queued stay unseen so they're picked up next time.
+    """
+    if server is None:
+        server = config['server']['ip']
+    started = time.time()
+    start_requests = upstream_requests()
+    report = {'started': datetime.now().isoformat(timespec='seconds'), 'discovered': 0, 'searched': 0,
+              'checked': 0, 'deferred': 0, 'queued': [], 'failed': [], 'errors': []}
+
+    def over_budget():
+        return upstream_requests() - start_requests >= budget
+
+    jobs = []
+    for search_term in search_terms:
+        entry = state['terms'].get(search_term)
+        if entry is None:
+            jobs.append((0, 'search', search_term))
+            continue
+        age = started - entry['last_discovered']
+        if age >= rediscover or (not entry['series'] and age >= retry_empty):
+            jobs.append((entry['last_discovered'], 'search', search_term))
+    watched = {key for term in search_terms for key in state['terms'].get(term, {}).get('series', [])}
+    jobs.extend((state['series'][key]['last_checked'], 'check', key) for key in watched)
+    jobs.sort(key=lambda job: job[0])
+
     br = mechanize.Browser()
     br.set_handle_robots(False)
-    for ea_link in final_links:
-        #print(ea_link)
-        url = f"http://{server}:54479{ea_link.get('href')}"
-        #print(url)
+    for _, kind, target in jobs:
+        if over_budget():
+            report['deferred'] += 1
+            continue
         try:
-            response = br.open(url)
-            page_source = response.read()
-            root = ET.fromstring(page_source)
-            for ea_result in root.findall('media_playlater'):
-                response = br.open(ea_result.get('src'))
-                page_source = response.read()
-                #print(page_source)
+            if kind == 'search':
+                known = set(state['series'])
+                discover_term(target, state, report, media_type, match_type, excluded_providers, over_budget, server)
+                # Check newly found series in this same cycle, budget permitting
+                jobs.extend((0, 'check', key) for key in state['terms'][target]['series']
+                            if key not in known and key not in watched)
+                watched.update(state['terms'][target]['series'])
+            else:
+                check_series(target, state, report, skip_existing, over_budget, br, server)
         except Exception as e:
-            print(e)
+            report['errors'].append({kind: target, 'error': str(e)})
 
+    report['requests'] = upstream_requests() - start_requests
+    report['elapsed'] = round(time.time() - started, 2)
+    return report
+
+def discover_term(search_term, state, report, media_type, match_type, excluded_providers, over_budget, server):
+    entry = state['terms'].get(search_term, {'series': [], 'last_discovered': 0})
+    series_keys = set(entry['series'])
+    searched = set(entry.get('searched_providers', []))
+    found, complete = discover_series(search_term, media_type, match_type, excluded_providers, server,
+                                      over_budget, searched)
+    for ea_result in found:
+        key = ea_result['href']
+        if key not in state['series']:
+            state['series'][key] = {'name': ea_result['name'], 'provider': ea_result['provider'],
+                                    'type': ea_result['type'], 'seen': [], 'last_checked': 0}
+            report['discovered'] += 1
+        series_keys.add(key)
+    if complete:
+        state['terms'][search_term] = {'series': sorted(series_keys), 'last_discovered': time.time()}
+        report['searched'] += 1
+    else:
+        # Leave it due, next cycle picks up from the providers that haven't been searched yet
+        state['terms'][search_term] = {'series': sorted(series_keys), 'last_discovered': entry['last_discovered'],
+                                       'searched_providers': sorted(searched)}
+        report['deferred'] += 1
+
+def check_series(key, state, report, skip_existing, over_budget, br, server):
+    series = state['series'][key]
+    first_check = series['last_checked'] == 0
+    seen = set(series['seen'])
+    links = trace_folder({'href': key, 'name': series['name']}, server)
+    report['checked'] += 1
+    complete = True
+    for ea_link in links:
+        href = ea_link.get('href')
+        # An empty folder traces back to itself, that's the series not an episode
+        if href in seen or href == key:
+            continue
+        if first_check and skip_existing:
+            seen.add(href)
+            continue
+        if over_budget():
+            complete = False
+            break
+        if queue_episode(ea_link, server, br):
+            seen.add(href)
+            report['queued'].append({'series': series['name'], 'episode': ea_link.get('name'), 'href': href})
+        else:
+            # Leave it unseen so the next cycle retries it
+            report['failed'].append({'series': series['name'], 'episode': ea_link.get('name'), 'href': href})
+    series['seen'] = sorted(seen)
+    if complete:
+        series['last_checked'] = time.time()
+    else:
+        # Out of budget part way through, keep it at the front of the queue for next cycle
+        report['deferred'] += 1
 
 
 if __name__ == '__main__':
@@ -178,8 +435,17 @@ if __name__ == '__main__':
     parser.add_argument("--media", default='show', help="only specific types of media")
     parser.add_argument('search_term', nargs='*',
                         help='One or more text arguments.')
-    parser.add_argument("--exclude", dest='excluded_providers', default='', action="append", help="exclude provider(s). Specify multiple with ")
+    parser.add_argument("--exclude", dest='excluded_providers', default=[], action="append", help="exclude provider(s). Specify multiple with ")
     parser.add_argument("--record", action="store_true", default=False, help="add to record queue automatically")
+    parser.add_argument("--watch", action="store_true", default=False, help="only queue episodes not seen on a previous run")
+    parser.add_argument("--interval", type=int, default=0, help="with --watch, seconds between cycles (0 runs a single cycle, for cron)")
+    parser.add_argument("--state-file", default=str(Path(__file__).parent / 'watch_state.json'), help="with --watch, where seen episodes are stored")
+    parser.add_argument("--budget", type=int, default=50, help="with --watch, max upstream requests per cycle")
+    parser.add_argument("--retry-empty", type=int, default=3600, help="with --watch, seconds before searching again for a term with no series yet")
+    parser.add_argument("--rediscover", type=int, default=86400, help="with --watch, seconds before searching again for new series of a term")
+    parser.add_argument("--skip-existing", action="store_true", default=False, help="with --watch, mark episodes already on a new series as seen instead of queueing them")
+    parser.add_argument("--batch", default=None, help="file with one search term per line ('-' for stdin), results are written as JSON lines")
+    parser.add_argument("--jobs", type=int, default=8, help="with --batch, provider lookups to run at once")
     args = parser.parse_args()
 
     if args.media not in ('show', 'movie'):
@@ -189,6 +455,45 @@ if __name__ == '__main__':
         providers = get_providers(server="127.0.0.1")
         sys.exit('\n'.join(providers))
 
+    if args.watch:
+        # Each positional arg is its own search term in watch mode, e.g. "Bluey" "Doctor Who"
+        match_type = 'exact' if args.exact else 'partial'
+        while True:
+            state = load_watch_state(args.state_file)
+            try:
+                with upstream_priority('record'):
+                    report = watch_cycle(args.search_term, state, args.media, match_type, args.excluded_providers,
+                                         budget=args.budget, skip_existing=args.skip_existing,
+                                         retry_empty=args.retry_empty, rediscover=args.rediscover)
+            except Exception as e:
+                # Keep the daemon going, whatever got queued before the error is already in state
+                report = {'started': datetime.now().isoformat(timespec='seconds'), 'error': str(e)}
+            save_watch_state(state, args.state_file)
+            print(json.dumps(report))
+            if args.interval <= 0:
+                break
+            time.sleep(args.interval)
+        sys.exit(0)
+
+    if args.batch:
+        try:
+            terms_file = sys.stdin if args.batch == '-' else open(args.batch, 'r')
+        except OSError as e:
+            sys.exit(f"Can't read search terms from {args.batch}: {e.strerror}")
+        with terms_file:
+            search_terms = list(dict.fromkeys(line.strip() for line in terms_file if line.strip()))
+        match_type = 'exact' if args.exact else 'partial'
+        out = sys.stdout
+        # The lookup functions print as they go, keep that out of the JSON stream
+        sys.stdout = sys.stderr
+        batch_search(search_terms, args.media, match_type, args.excluded_providers, max(1, args.jobs), out, sys.stderr)
+        try:
+            out.flush()
+        except BrokenPipeError:
+            # Stop the interpreter complaining about the closed pipe again on exit
+            os.dup2(os.open(os.devnull, os.O_WRONLY), out.fileno())
+        sys.exit(0)
+
     providers = get_providers()
     filtered_results = []
     for ea_provider in providers:
@@ -199,7 +504,7 @@ if __name__ == '__main__':
         text_search_term = ' '.join(args.search_term)
         results = query_provider(providers[ea_provider]['id'], url_search_term)
         print(f"Found {len(results)} results for {text_search_term} in {ea_provider}")
-        filtered_results.extend(filter_results(results, text_search_term, args.media, args.exact))
+        filtered_results.extend(filter_results(results, text_search_term, args.media, 'exact' if args.exact else 'partial'))
     for ea_result in filtered_results:
         print(f"Found result: {ea_result}")
         if args.record:
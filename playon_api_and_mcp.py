@@ -1,28 +1,76 @@
 import re
+import sys
 import json
+import os
+import time
+import asyncio
+import hashlib
+import secrets
+import threading
+import contextvars
 import mechanize
 import xml.etree.ElementTree as ET
 from fastapi import FastAPI, Query, HTTPException, Request
-from fastapi.responses import JSONResponse
-from typing import Dict, List, Optional, Any
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, Response
+from starlette.concurrency import run_in_threadpool
+from typing import Dict, List, Optional, Any, Union, Iterator, Callable, Tuple
+from collections import OrderedDict, deque
 from pydantic import BaseModel
 from datetime import datetime
+from contextlib import asynccontextmanager
+
+from playon_tracing import traced, start_trace, profiler, recent_traces
+from playon_store import SQLiteStore, default_cache_path
+from playon_upstream import upstream_cache, upstream_priority, scheduler, worker_share, workers
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Samples event loop lag for /debug/loop for as long as the app is up
+    loop_lag_task = asyncio.create_task(monitor_loop_lag())
+    try:
+        yield
+    finally:
+        loop_lag_task.cancel()
+
 
 app = FastAPI(title="Media Provider API with MCP Server",
-              description="API for searching and retrieving media from providers with MCP support")
+              description="API for searching and retrieving media from providers with MCP support",
+              lifespan=lifespan)
+# Search results and folder traces can run to hundreds of KB of JSON, small replies aren't worth compressing
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+# Trace every request, otherwise only those sent with "X-Trace: 1" or ?trace=1
+TRACE_ALL_REQUESTS = os.environ.get("PLAYON_TRACE", "") == "1"
+
+
+@app.middleware("http")
+async def tracing_middleware(request: Request, call_next):
+    if request.url.path.startswith("/debug/"):
+        return await call_next(request)
+    enabled = (TRACE_ALL_REQUESTS or request.headers.get("x-trace") == "1"
+               or request.query_params.get("trace") == "1")
+    # MCP clients are usually an assistant waiting on a reply, so they jump the upstream queue
+    priority = "interactive" if request.url.path == "/mcp" else "rest"
+    with upstream_priority(priority), start_trace(f"{request.method} {request.url.path}", enabled) as trace:
+        response = await call_next(request)
+    if trace is not None:
+        response.headers["X-Trace-Id"] = trace.trace_id
+    return response
 
 
 # MCP Protocol Models
 class MCPRequest(BaseModel):
     jsonrpc: str = "2.0"
-    id: Optional[str] = None
+    id: Optional[Union[str, int]] = None
     method: str
     params: Optional[Dict[str, Any]] = None
 
 
 class MCPResponse(BaseModel):
     jsonrpc: str = "2.0"
-    id: Optional[str] = None
+    id: Optional[Union[str, int]] = None
     result: Optional[Any] = None
     error: Optional[Dict[str, Any]] = None
 
@@ -43,7 +91,7 @@ MCP_TOOLS = [
             "properties": {
                 "search_term": {
                     "type": "string",
-                    "description": "The media title to search for"
+                    "description": "The media title to search for (required unless continuing from a cursor)"
                 },
                 "media_type": {
                     "type": "string",
@@ -67,9 +115,23 @@ MCP_TOOLS = [
                     "type": "string",
                     "description": "Media server IP address",
                     "default": "192.168.2.14"
+                },
+                "cursor": {
+                    "type": "string",
+                    "description": "Cursor from a previous page of results; the other arguments are ignored when given"
+                },
+                "limit": {
+                    "type": "integer",
+                    "description": "Maximum number of items to return in this page",
+                    "default": 50
+                },
+                "max_bytes": {
+                    "type": "integer",
+                    "description": "Approximate size budget for this page of text, in bytes",
+                    "default": 16000
                 }
             },
-            "required": ["search_term"]
+            "required": []
         }
     ),
     ToolInfo(
@@ -89,17 +151,18 @@ MCP_TOOLS = [
     ),
     ToolInfo(
         name="trace_media_folder",
-        description="Explore the contents of a media folder to find video files",
+        description="Explore the contents of a media folder to find video files. "
+                    "Folders from an earlier search_media in the same session can be given by name alone",
         inputSchema={
             "type": "object",
             "properties": {
                 "href": {
                     "type": "string",
-                    "description": "The href path of the folder to explore"
+                    "description": "The href path of the folder to explore, looked up from earlier results if omitted"
                 },
                 "name": {
                     "type": "string",
-                    "description": "The name of the folder"
+                    "description": "The name of the folder (required unless continuing from a cursor)"
                 },
                 "provider": {
                     "type": "string",
@@ -113,20 +176,105 @@ MCP_TOOLS = [
                     "type": "string",
                     "description": "Media server IP address",
                     "default": "192.168.2.14"
+                },
+                "cursor": {
+                    "type": "string",
+                    "description": "Cursor from a previous page of results; the other arguments are ignored when given"
+                },
+                "limit": {
+                    "type": "integer",
+                    "description": "Maximum number of items to return in this page",
+                    "default": 50
+                },
+                "max_bytes": {
+                    "type": "integer",
+                    "description": "Approximate size budget for this page of text, in bytes",
+                    "default": 16000
                 }
             },
-            "required": ["href", "name", "provider", "type"]
+            "required": []
         }
     )
 ]
 
 
-# Original functions (unchanged)
-def get_providers(server: str = "192.168.2.14") -> Dict[str, Dict[str, str]]:
-    br = mechanize.Browser()
-    br.set_handle_robots(False)
-    response = br.open(f"http://{server}:54479/data/data.xml")
-    page_source = response.read()
+# MCP sessions
+SESSION_IDLE_SECONDS = 1800
+SESSION_MAX_ITEMS = 500
+# Providers and folder traces older than this are fetched again (and revalidated upstream)
+SESSION_FRESH_SECONDS = 60
+MAX_SESSIONS = 200
+# Sessions live in this process's memory. With --workers N the next request of a session can land
+# on any worker, so sessions are turned off there and every call is one-shot
+SESSIONS_ENABLED = workers == 1
+
+
+class MCPSession:
+    """
+    Warm state kept between calls on one MCP session: the provider map per server, results
+    from recent searches (by href and by name) and folders that have already been traced.
+    """
+
+    def __init__(self):
+        self.id = secrets.token_hex(16)
+        # Each store maps a key to (time remembered, value)
+        self.providers: "OrderedDict[str, Tuple[float, Dict[str, Dict[str, str]]]]" = OrderedDict()
+        self.results: "OrderedDict[str, Tuple[float, Dict[str, str]]]" = OrderedDict()
+        self.folders: "OrderedDict[str, Tuple[float, List[Dict[str, str]]]]" = OrderedDict()
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+    def remember(self, store: OrderedDict, key: str, value: Any):
+        # Tool calls on the same session can run in different threads at once
+        with self.lock:
+            store[key] = (time.monotonic(), value)
+            store.move_to_end(key)
+            while len(store) > SESSION_MAX_ITEMS:
+                store.popitem(last=False)
+
+    def recall(self, store: OrderedDict, key: str) -> Any:
+        """Value remembered under key, None if there isn't one or it's gone stale"""
+        with self.lock:
+            entry = store.get(key)
+        if entry is None or time.monotonic() - entry[0] > SESSION_FRESH_SECONDS:
+            return None
+        return entry[1]
+
+    def get_providers(self, server: str) -> Dict[str, Dict[str, str]]:
+        providers = self.recall(self.providers, server)
+        if providers is None:
+            providers = get_providers(server)
+            self.remember(self.providers, server, providers)
+        return providers
+
+    def resolve(self, name: str, provider: Optional[str] = None) -> Optional[Dict[str, str]]:
+        """Most recent search result with this name (and provider, if given)"""
+        with self.lock:
+            results = [result for _, result in self.results.values()]
+        for result in reversed(results):
+            if result['name'] == name and (provider is None or result['provider'] == provider):
+                return result
+        return None
+
+
+# Only touched from the event loop (the /mcp handlers and serve_stdio), never from tool threads
+sessions: "OrderedDict[str, MCPSession]" = OrderedDict()
+current_session = contextvars.ContextVar("current_session", default=None)
+
+
+def create_session() -> MCPSession:
+    now = time.monotonic()
+    for session_id in [sid for sid, ea in sessions.items() if now - ea.last_used > SESSION_IDLE_SECONDS]:
+        del sessions[session_id]
+    session = MCPSession()
+    sessions[session.id] = session
+    while len(sessions) > MAX_SESSIONS:
+        sessions.popitem(last=False)
+    return session
+
+
+# Original functions, fetching through the revalidating upstream cache
+def parse_providers(page_source: bytes) -> Dict[str, Dict[str, str]]:
     root = ET.fromstring(page_source)
 
     providers = {}
@@ -139,43 +287,64 @@ def get_providers(server: str = "192.168.2.14") -> Dict[str, Dict[str, str]]:
     return providers
 
 
+@traced('get_providers', 'server')
+def get_providers(server: str = "192.168.2.14") -> Dict[str, Dict[str, str]]:
+    br = mechanize.Browser()
+    br.set_handle_robots(False)
+    return dict(upstream_cache.fetch(br, f"http://{server}:54479/data/data.xml", parse_providers))
+
+
+@traced('query_provider', 'provider', 'search_term')
 def query_provider(provider: str, search_term: str, server: str = "192.168.2.14") -> List[Dict[str, str]]:
     br = mechanize.Browser()
     br.set_handle_robots(False)
     url = f"http://{server}:54479/data/data.xml?id={provider}&searchterm={search_term}"
-    results = []
 
-    try:
-        response = br.open(url)
-        page_source = response.read()
+    def parse(page_source: bytes) -> List[Dict[str, str]]:
         root = ET.fromstring(page_source)
+        return [
+            {
+                'href': ea_result.get('href'),
+                'name': ea_result.get('name'),
+                'provider': provider,
+                'type': ea_result.get('type')
+            }
+            for ea_result in root.findall('group')
+            if 'id' not in ea_result.attrib
+        ]
+
+    results = []
 
-        for ea_result in root.findall('group'):
-            if 'id' not in ea_result.attrib:
-                results.append({
-                    'href': ea_result.get('href'),
-                    'name': ea_result.get('name'),
-                    'provider': provider,
-                    'type': ea_result.get('type')
-                })
+    try:
+        results = upstream_cache.fetch(br, url, parse)
     except Exception as e:
         print(f"Error querying provider: {e}")
 
     return results
 
 
+def parse_folder(page_source: bytes) -> List[Dict[str, str]]:
+    root = ET.fromstring(page_source)
+    return [dict(ea_result.attrib) for ea_result in root.findall('group')]
+
+
+@traced('trace_folder', 'result')
 def trace_folder(result: Dict[str, str], server: str = "192.168.2.14") -> List[Dict[str, str]]:
+    session = current_session.get()
+    folder_key = f"{server}{result['href']}"
+    cached = session.recall(session.folders, folder_key) if session is not None else None
+    if cached is not None:
+        return list(cached)
+
     br = mechanize.Browser()
     br.set_handle_robots(False)
     url = f"http://{server}:54479{result['href']}"
     search_results = []
 
     try:
-        response = br.open(url)
-        page_source = response.read()
-        root = ET.fromstring(page_source)
-
-        for ea_result in root.findall('group'):
+        # Subfolders are still revalidated individually, an unchanged parent
+        # doesn't mean an unchanged season folder
+        for ea_result in upstream_cache.fetch(br, url, parse_folder):
             if ea_result.get('href') == result['href']:
                 continue
 
@@ -186,7 +355,10 @@ def trace_folder(result: Dict[str, str], server: str = "192.168.2.14") -> List[D
                 search_results.append(ea_result)
     except Exception as e:
         print(f"Error tracing folder: {e}")
+        return search_results
 
+    if session is not None:
+        session.remember(session.folders, folder_key, search_results)
     return search_results
 
 
@@ -212,20 +384,192 @@ def single_match(result: Dict[str, str], pattern: re.Pattern, media_type: str, s
         return False
 
 
-def filter_results(results: List[Dict[str, str]], search_term: str, media_type: str, match_type: str = 'partial') -> \
-List[Dict[str, str]]:
-    pattern = re.compile(".*" + search_term, re.IGNORECASE)
+def match_pattern(search_term: str, match_type: str = 'partial') -> re.Pattern:
+    # Search terms are titles, not regular expressions
     if match_type == 'exact':
-        pattern = re.compile(f"^{search_term}$", re.IGNORECASE)
+        return re.compile(f"^{re.escape(search_term)}$", re.IGNORECASE)
+    return re.compile(".*" + re.escape(search_term), re.IGNORECASE)
+
+
+@traced('filter_results', 'search_term', 'media_type')
+def filter_results(results: List[Dict[str, str]], search_term: str, media_type: str, match_type: str = 'partial',
+                   server: str = "192.168.2.14") -> List[Dict[str, str]]:
+    pattern = match_pattern(search_term, match_type)
 
     filtered_results = [
         result for result in results
-        if single_match(result, pattern, media_type)
+        if single_match(result, pattern, media_type, server)
     ]
 
     return filtered_results
 
 
+# Lazy versions of the search and trace loops, for paging through large results
+def iter_search(session: "MCPSession", search_term: str, media_type: str, match_type: str,
+                excluded_providers: List[str], server: str) -> Iterator[Dict[str, str]]:
+    pattern = match_pattern(search_term, match_type)
+    url_search_term = '%20'.join(search_term.split())
+    for provider_name, provider_info in session.get_providers(server).items():
+        if provider_name in excluded_providers:
+            continue
+        for result in query_provider(provider_info['id'], url_search_term, server):
+            if single_match(result, pattern, media_type, server):
+                session.remember(session.results, result['href'], result)
+                yield result
+
+
+def iter_trace_folder(result: Dict[str, str], server: str) -> Iterator[Dict[str, str]]:
+    """Same walk as trace_folder, but subfolders are only fetched once the caller gets to them"""
+    session = current_session.get()
+    folder_key = f"{server}{result['href']}"
+    cached = session.recall(session.folders, folder_key) if session is not None else None
+    if cached is not None:
+        yield from list(cached)
+        return
+
+    br = mechanize.Browser()
+    br.set_handle_robots(False)
+    try:
+        groups = upstream_cache.fetch(br, f"http://{server}:54479{result['href']}", parse_folder)
+    except Exception as e:
+        print(f"Error tracing folder: {e}")
+        return
+
+    search_results = []
+    for ea_result in groups:
+        if ea_result.get('href') == result['href']:
+            continue
+
+        if ea_result.get('childs', None) is not None:
+            for item in iter_trace_folder(ea_result, server):
+                search_results.append(item)
+                yield item
+
+        if ea_result.get('type') == 'video':
+            search_results.append(ea_result)
+            yield ea_result
+
+    # Only a folder that was walked to the end is complete enough to reuse
+    if session is not None:
+        session.remember(session.folders, folder_key, search_results)
+
+
+# Server-side cursors for paged tool results
+DEFAULT_PAGE_LIMIT = 50
+DEFAULT_PAGE_BYTES = 16000
+CURSOR_IDLE_SECONDS = 1800
+MAX_CURSORS = 200
+# Cursors live in this process's memory, so with --workers N a follow-up call could land on a
+# worker that never saw the cursor. Paging is turned off there and each call returns everything
+CURSORS_ENABLED = workers == 1
+
+
+class ResultCursor:
+    """
+    A partly consumed result iterator. Each page pulls items until either the item limit or the
+    byte budget is reached; the item that would have gone over the budget is held for the next page.
+    """
+
+    def __init__(self, tool: str, header: Callable[[int], str], title: str, items: Iterator[Dict[str, str]],
+                 format_item: Callable[[Dict[str, str]], str]):
+        self.id = secrets.token_urlsafe(16)
+        self.tool = tool
+        self.header = header
+        self.title = title
+        self.items = items
+        self.format_item = format_item
+        self.pending: Optional[str] = None
+        self.sent = 0
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+    def next_page(self, limit: int, max_bytes: int) -> Tuple[List[str], bool]:
+        lines = []
+        size = 0
+        while len(lines) < limit:
+            if self.pending is not None:
+                line, self.pending = self.pending, None
+            else:
+                item = next(self.items, None)
+                if item is None:
+                    return lines, True
+                line = self.format_item(item)
+            line_size = len(line.encode("utf-8")) + 1
+            # Always return at least one item, even if it's over budget by itself
+            if lines and size + line_size > max_bytes:
+                self.pending = line
+                break
+            lines.append(line)
+            size += line_size
+        # No look-ahead: the next item can mean querying another provider, which waits for the next page.
+        # When the last page ends exactly on the limit, the call after it comes back empty and done
+        return lines, False
+
+    def page(self, limit: int, max_bytes: int) -> Dict[str, Any]:
+        if not CURSORS_ENABLED:
+            limit = max_bytes = sys.maxsize
+        # Two calls with the same cursor would otherwise resume the generator at the same time
+        with self.lock:
+            return self._page(limit, max_bytes)
+
+    def _page(self, limit: int, max_bytes: int) -> Dict[str, Any]:
+        self.last_used = time.monotonic()
+        start = self.sent
+        lines, done = self.next_page(max(1, limit), max(1, max_bytes))
+        self.sent += len(lines)
+        if done:
+            drop_cursor(self.id)
+        else:
+            store_cursor(self)
+
+        if done and start == 0:
+            # Everything fit in one page, same output as before paging existed
+            text = f"{self.header(len(lines))}:\n\n" + "\n".join(lines)
+        elif not lines:
+            text = f"{self.title}: no more results.\n\nEnd of results."
+        else:
+            text = f"{self.title} ({start + 1}-{self.sent}):\n\n" + "\n".join(lines)
+            if done:
+                text += "\n\nEnd of results."
+            else:
+                text += f"\n\nMore results available, call {self.tool} again with cursor \"{self.id}\"."
+        return {
+            "content": [{"type": "text", "text": text}],
+            "isError": False
+        }
+
+
+cursors: "OrderedDict[str, ResultCursor]" = OrderedDict()
+# Tool calls run in threadpool threads, so every access to cursors goes through this lock
+cursors_lock = threading.Lock()
+
+
+def store_cursor(cursor: ResultCursor):
+    now = time.monotonic()
+    with cursors_lock:
+        for cursor_id in [cid for cid, ea in cursors.items() if now - ea.last_used > CURSOR_IDLE_SECONDS]:
+            del cursors[cursor_id]
+        cursors[cursor.id] = cursor
+        cursors.move_to_end(cursor.id)
+        while len(cursors) > MAX_CURSORS:
+            cursors.popitem(last=False)
+
+
+def drop_cursor(cursor_id: str):
+    with cursors_lock:
+        cursors.pop(cursor_id, None)
+
+
+def take_cursor(cursor_id: str, tool: str) -> ResultCursor:
+    if not CURSORS_ENABLED:
+        raise ValueError("Cursors need the server to run with a single worker")
+    with cursors_lock:
+        cursor = cursors.get(cursor_id)
+    if cursor is None or cursor.tool != tool:
+        raise ValueError(f"Unknown or expired cursor: {cursor_id}")
+    return cursor
+
+
 # MCP Protocol Handlers
 async def handle_initialize(params: Dict[str, Any]) -> Dict[str, Any]:
     """Handle MCP initialize request"""
@@ -250,49 +594,52 @@ async def handle_tools_list(params: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 
-async def handle_tools_call(params: Dict[str, Any]) -> Dict[str, Any]:
+async def handle_tools_call(params: Dict[str, Any], session: Optional[MCPSession] = None) -> Dict[str, Any]:
     """Handle MCP tools/call request"""
+    # The tools block on upstream requests and scheduler/single-flight waits, run them off the
+    # event loop. The thread gets a copy of the context, so priority, trace and session carry over
+    return await run_in_threadpool(call_tool, params, session)
+
+
+def call_tool(params: Dict[str, Any], session: Optional[MCPSession] = None) -> Dict[str, Any]:
     tool_name = params.get("name")
     arguments = params.get("arguments", {})
+    if session is None:
+        # One-shot request, state only lives for this call
+        session = MCPSession()
+    session.last_used = time.monotonic()
+    token = current_session.set(session)
 
     try:
         if tool_name == "search_media":
+            limit = int(arguments.get("limit", DEFAULT_PAGE_LIMIT))
+            max_bytes = int(arguments.get("max_bytes", DEFAULT_PAGE_BYTES))
+            if arguments.get("cursor"):
+                return take_cursor(arguments["cursor"], tool_name).page(limit, max_bytes)
+
             search_term = arguments.get("search_term")
             media_type = arguments.get("media_type", "show")
             match_type = arguments.get("match_type", "partial")
             excluded_providers = arguments.get("excluded_providers", [])
             server = arguments.get("server", "192.168.2.14")
 
+            if not search_term:
+                raise ValueError("search_term is required")
             if media_type not in ['show', 'movie']:
                 raise ValueError("Media type must be 'show' or 'movie'")
 
-            providers = get_providers(server)
-            filtered_results = []
-
-            for provider_name, provider_info in providers.items():
-                if provider_name in excluded_providers:
-                    continue
-
-                url_search_term = '%20'.join(search_term.split())
-                results = query_provider(provider_info['id'], url_search_term, server)
-                filtered_results.extend(
-                    filter_results(results, search_term, media_type, match_type)
-                )
-
-            return {
-                "content": [
-                    {
-                        "type": "text",
-                        "text": f"Found {len(filtered_results)} results for '{search_term}':\n\n" +
-                                "\n".join([f"• {r['name']} ({r['type']}) - {r['provider']}" for r in filtered_results])
-                    }
-                ],
-                "isError": False
-            }
+            cursor = ResultCursor(
+                tool_name,
+                header=lambda count: f"Found {count} results for '{search_term}'",
+                title=f"Results for '{search_term}'",
+                items=iter_search(session, search_term, media_type, match_type, excluded_providers, server),
+                format_item=lambda r: f"• {r['name']} ({r['type']}) - {r['provider']}"
+            )
+            return cursor.page(limit, max_bytes)
 
         elif tool_name == "list_providers":
             server = arguments.get("server", "192.168.2.14")
-            providers = get_providers(server)
+            providers = session.get_providers(server)
 
             return {
                 "content": [
@@ -306,6 +653,11 @@ async def handle_tools_call(params: Dict[str, Any]) -> Dict[str, Any]:
             }
 
         elif tool_name == "trace_media_folder":
+            limit = int(arguments.get("limit", DEFAULT_PAGE_LIMIT))
+            max_bytes = int(arguments.get("max_bytes", DEFAULT_PAGE_BYTES))
+            if arguments.get("cursor"):
+                return take_cursor(arguments["cursor"], tool_name).page(limit, max_bytes)
+
             result = {
                 "href": arguments.get("href"),
                 "name": arguments.get("name"),
@@ -314,19 +666,22 @@ async def handle_tools_call(params: Dict[str, Any]) -> Dict[str, Any]:
             }
             server = arguments.get("server", "192.168.2.14")
 
-            folder_contents = trace_folder(result, server)
-
-            return {
-                "content": [
-                    {
-                        "type": "text",
-                        "text": f"Contents of folder '{result['name']}':\n\n" +
-                                "\n".join([f"• {item.get('name', 'Unknown')} ({item.get('type', 'unknown')})"
-                                           for item in folder_contents])
-                    }
-                ],
-                "isError": False
-            }
+            if not result["href"]:
+                if not result["name"]:
+                    raise ValueError("name or href is required")
+                known = session.resolve(result["name"], result["provider"])
+                if known is None:
+                    raise ValueError(f"No href given and no earlier result named '{result['name']}' in this session")
+                result = dict(known)
+
+            cursor = ResultCursor(
+                tool_name,
+                header=lambda count: f"Contents of folder '{result['name']}'",
+                title=f"Contents of folder '{result['name']}'",
+                items=iter_trace_folder(result, server),
+                format_item=lambda item: f"• {item.get('name', 'Unknown')} ({item.get('type', 'unknown')})"
+            )
+            return cursor.page(limit, max_bytes)
 
         else:
             raise ValueError(f"Unknown tool: {tool_name}")
@@ -342,46 +697,71 @@ async def handle_tools_call(params: Dict[str, Any]) -> Dict[str, Any]:
             "isError": True
         }
 
+    finally:
+        current_session.reset(token)
 
-# MCP Endpoints
-@app.post("/mcp")
-async def mcp_endpoint(request: Request):
-    """Main MCP protocol endpoint"""
-    try:
-        body = await request.body()
-        data = json.loads(body)
 
+# MCP message dispatch, shared by the HTTP and stdio transports
+async def handle_mcp_message(data: Any, session: Optional[MCPSession] = None) -> Optional[Dict[str, Any]]:
+    """
+    Handle one JSON-RPC message and return the response, or None for a notification
+    """
+    try:
         mcp_request = MCPRequest(**data)
+    except Exception as e:
+        error_response = MCPResponse(
+            error={
+                "code": -32700,
+                "message": f"Parse error: {str(e)}"
+            }
+        )
+        return error_response.dict(exclude_none=True)
 
-        result = None
-        error = None
+    if mcp_request.method.startswith("notifications/"):
+        return None
 
-        try:
-            if mcp_request.method == "initialize":
-                result = await handle_initialize(mcp_request.params or {})
-            elif mcp_request.method == "tools/list":
-                result = await handle_tools_list(mcp_request.params or {})
-            elif mcp_request.method == "tools/call":
-                result = await handle_tools_call(mcp_request.params or {})
-            else:
-                error = {
-                    "code": -32601,
-                    "message": f"Method not found: {mcp_request.method}"
-                }
-        except Exception as e:
+    result = None
+    error = None
+
+    try:
+        if mcp_request.method == "initialize":
+            result = await handle_initialize(mcp_request.params or {})
+        elif mcp_request.method == "tools/list":
+            result = await handle_tools_list(mcp_request.params or {})
+        elif mcp_request.method == "tools/call":
+            result = await handle_tools_call(mcp_request.params or {}, session)
+        elif mcp_request.method == "ping":
+            result = {}
+        else:
             error = {
-                "code": -32603,
-                "message": f"Internal error: {str(e)}"
+                "code": -32601,
+                "message": f"Method not found: {mcp_request.method}"
             }
+    except Exception as e:
+        error = {
+            "code": -32603,
+            "message": f"Internal error: {str(e)}"
+        }
 
-        response = MCPResponse(
-            id=mcp_request.id,
-            result=result,
-            error=error
-        )
+    response = MCPResponse(
+        id=mcp_request.id,
+        result=result,
+        error=error
+    )
+    return response.dict(exclude_none=True)
 
-        return JSONResponse(response.dict(exclude_none=True))
 
+# MCP Endpoints
+@app.post("/mcp")
+async def mcp_endpoint(request: Request):
+    """
+    Main MCP protocol endpoint. Plain one-shot POSTs work as before; clients that keep the
+    Mcp-Session-Id returned from initialize (streamable HTTP) get a warm session.
+    With more than one worker no session id is handed out and every call is one-shot
+    """
+    try:
+        body = await request.body()
+        data = json.loads(body)
     except Exception as e:
         error_response = MCPResponse(
             error={
@@ -391,18 +771,114 @@ async def mcp_endpoint(request: Request):
         )
         return JSONResponse(error_response.dict(exclude_none=True))
 
+    messages = data if isinstance(data, list) else [data]
+    session = None
+    headers = {}
+    session_id = request.headers.get("mcp-session-id")
+    if not SESSIONS_ENABLED:
+        # A session id from a client that ignored the missing header is treated as one-shot too
+        session_id = None
+    if session_id:
+        session = sessions.get(session_id)
+        if session is None:
+            return JSONResponse({"error": "Unknown or expired session"}, status_code=404)
+        sessions.move_to_end(session_id)
+    elif SESSIONS_ENABLED and any(isinstance(message, dict) and message.get("method") == "initialize"
+                                  for message in messages):
+        session = create_session()
+    if session is not None:
+        headers["Mcp-Session-Id"] = session.id
+
+    responses = [response for response in [await handle_mcp_message(message, session) for message in messages]
+                 if response is not None]
+    if not responses:
+        return Response(status_code=202, headers=headers)
+    return JSONResponse(responses if isinstance(data, list) else responses[0], headers=headers)
+
+
+@app.delete("/mcp")
+async def mcp_end_session(request: Request):
+    """End a streamable HTTP session"""
+    if sessions.pop(request.headers.get("mcp-session-id", ""), None) is None:
+        return Response(status_code=404)
+    return Response(status_code=204)
+
+
+async def serve_stdio():
+    """
+    Long-lived MCP over stdio: one JSON-RPC message per line in, one response per line out,
+    all on a single session
+    """
+    protocol_out = sys.stdout
+    # The upstream helpers print their errors, keep them out of the protocol stream
+    sys.stdout = sys.stderr
+    session = create_session()
+    loop = asyncio.get_running_loop()
+    with upstream_priority("interactive"):
+        while True:
+            line = await loop.run_in_executor(None, sys.stdin.readline)
+            if not line:
+                break
+            if not line.strip():
+                continue
+            try:
+                data = json.loads(line)
+            except json.JSONDecodeError as e:
+                responses = [MCPResponse(error={"code": -32700, "message": f"Parse error: {str(e)}"}).dict(exclude_none=True)]
+            else:
+                messages = data if isinstance(data, list) else [data]
+                responses = [response for response in [await handle_mcp_message(message, session) for message in messages]
+                             if response is not None]
+                if isinstance(data, list) and responses:
+                    responses = [responses]
+            for response in responses:
+                protocol_out.write(json.dumps(response) + "\n")
+                protocol_out.flush()
+
+
+# HTTP caching for the REST endpoints
+PROVIDERS_MAX_AGE = 300
+SEARCH_MAX_AGE = 60
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, gzip changes the bytes on the wire but not the representation
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag.removeprefix("W/") in candidates
+
+
+def cached_json_response(request: Request, payload: Any, max_age: int) -> Response:
+    """
+    Serialize payload once, tag it with an ETag of the body and answer 304 if the
+    client already has that version
+    """
+    body = json.dumps(payload, separators=(",", ":"), sort_keys=True).encode("utf-8")
+    etag = f'W/"{hashlib.sha1(body).hexdigest()}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"private, max-age={max_age}",
+    }
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
-# Original FastAPI endpoints (unchanged)
+
+# Original FastAPI endpoints, now with ETag / Cache-Control
 @app.get("/providers", response_model=Dict[str, Dict[str, str]])
-def list_providers_endpoint(server: str = "192.168.2.14"):
+def list_providers_endpoint(request: Request, server: str = "192.168.2.14"):
     """
     Get list of available media providers
     """
-    return get_providers(server)
+    return cached_json_response(request, get_providers(server), PROVIDERS_MAX_AGE)
 
 
 @app.get("/search", response_model=List[Dict[str, str]])
 def search_media_endpoint(
+        request: Request,
         search_term: str = Query(..., description="Search term for media"),
         media_type: str = Query('show', description="Type of media (show or movie)"),
         match_type: str = Query('partial', description="Matching type (partial or exact)"),
@@ -425,10 +901,81 @@ def search_media_endpoint(
         url_search_term = '%20'.join(search_term.split())
         results = query_provider(provider_info['id'], url_search_term, server)
         filtered_results.extend(
-            filter_results(results, search_term, media_type, match_type)
+            filter_results(results, search_term, media_type, match_type, server)
         )
 
-    return filtered_results
+    return cached_json_response(request, filtered_results, SEARCH_MAX_AGE)
+
+
+# Debug endpoints
+@app.get("/debug/traces")
+def debug_traces(trace_id: Optional[str] = None, format: str = Query('summary', description="summary or otlp")):
+    """
+    Recently finished request traces, newest first. format=otlp returns OTLP/JSON
+    that can be posted to an OpenTelemetry collector's /v1/traces as-is
+    """
+    traces = [trace for trace in reversed(recent_traces) if trace_id is None or trace.trace_id == trace_id]
+    if format == "otlp":
+        return {"resourceSpans": [rs for trace in traces for rs in trace.to_otlp()["resourceSpans"]]}
+    return [trace.summary() for trace in traces]
+
+
+@app.post("/debug/profile")
+def arm_profile(requests: int = Query(10, ge=1, le=1000), interval_ms: int = Query(5, ge=1, le=1000)):
+    """
+    Turn on sampling profiling for the next N requests, discarding the previous dump
+    """
+    profiler.arm(requests, interval_ms)
+    return profiler.dump()
+
+
+@app.get("/debug/profile")
+def get_profile(format: str = Query('json', description="json or folded")):
+    """
+    Stacks sampled so far. format=folded returns collapsed stacks for flamegraph.pl / speedscope
+    """
+    dump = profiler.dump()
+    if format == "folded":
+        return Response(content="\n".join(dump["folded"]) + "\n", media_type="text/plain")
+    return dump
+
+
+@app.get("/debug/upstream")
+def debug_upstream():
+    """
+    Upstream scheduler queue depths and waits per priority class, plus revalidation cache hits
+    """
+    return {"scheduler": scheduler.metrics(), "cache": dict(upstream_cache.stats)}
+
+
+# Event loop lag, sampled by a background task: how late a 100ms sleep wakes up
+LOOP_LAG_INTERVAL = 0.1
+loop_lag_samples = deque(maxlen=36000)
+
+
+async def monitor_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag_samples.append((time.time(), loop.time() - started - LOOP_LAG_INTERVAL))
+
+
+@app.get("/debug/loop")
+def debug_loop(since: float = Query(0, description="Only count samples taken after this unix time")):
+    """
+    Event loop lag percentiles in milliseconds for this worker process
+    """
+    lags = sorted(lag for taken, lag in list(loop_lag_samples) if taken >= since)
+    if not lags:
+        return {"pid": os.getpid(), "samples": 0}
+    return {
+        "pid": os.getpid(),
+        "samples": len(lags),
+        "p50_ms": round(lags[len(lags) // 2] * 1000, 2),
+        "p99_ms": round(lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000, 2),
+        "max_ms": round(lags[-1] * 1000, 2),
+    }
 
 
 @app.get("/health")
@@ -438,6 +985,37 @@ def health_check():
 
 
 if __name__ == "__main__":
+    import argparse
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=8001)
+    parser = argparse.ArgumentParser(description="Media Provider API with MCP Server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="uvicorn worker processes (MCP sessions and result cursors need a single worker)")
+    parser.add_argument("--stdio", action="store_true", default=False,
+                        help="serve MCP over stdin/stdout instead of HTTP")
+    parser.add_argument("--shared-cache", default=None,
+                        help="SQLite file the workers share their upstream cache through "
+                             "(defaults to ~/.cache/playon/upstream_cache.sqlite3 when --workers > 1)")
+    args = parser.parse_args()
+
+    if args.stdio:
+        if args.shared_cache:
+            upstream_cache.store = SQLiteStore(args.shared_cache)
+        asyncio.run(serve_stdio())
+    elif args.workers > 1:
+        # Workers import this module fresh, so everything they need to agree on goes through the environment
+        try:
+            worker_share("PLAYON_UPSTREAM_CONCURRENCY", 4, args.workers)
+            if float(os.environ.get("PLAYON_UPSTREAM_RATE", 0)):
+                worker_share("PLAYON_UPSTREAM_BURST", 10, args.workers)
+        except ValueError as e:
+            parser.error(str(e))
+        os.environ["PLAYON_WORKERS"] = str(args.workers)
+        os.environ["PLAYON_SHARED_CACHE"] = args.shared_cache or default_cache_path()
+        uvicorn.run("playon_api_and_mcp:app", host=args.host, port=args.port, workers=args.workers)
+    else:
+        if args.shared_cache:
+            upstream_cache.store = SQLiteStore(args.shared_cache)
+        uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class MemoryStore:
+    """
+    Per-process LRU of revalidation entries, with single-flight claims so that
+    threads asking for the same URL at the same time share one upstream fetch.
+    """
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        with self.lock:
+            return self.entries.get(url)
+
+    def put(self, url, entry):
+        with self.lock:
+            self.entries[url] = entry
+            self.entries.move_to_end(url)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def claim(self, url):
+        """True if the caller should fetch url, False if someone else already is"""
+        with self.lock:
+            if url in self.inflight:
+                return False
+            self.inflight[url] = threading.Event()
+            return True
+
+    def release(self, url):
+        with self.lock:
+            event = self.inflight.pop(url, None)
+        if event is not None:
+            event.set()
+
+    def wait(self, url, timeout):
+        with self.lock:
+            event = self.inflight.get(url)
+        if event is not None:
+            event.wait(timeout)
+        return self.get(url)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SQLiteStore:
+    """
+    Revalidation entries and single-flight claims kept in a SQLite database in WAL mode,
+    so every uvicorn worker on the box shares one cache and one set of in-flight fetches.
+
+    Claims left behind by a worker that died mid-fetch expire after claim_timeout seconds.
+    """
+
+    def __init__(self, path, max_entries=2048, claim_timeout=30, poll_interval=0.05):
+        self.path = str(path)
+        self.max_entries = max_entries
+        self.claim_timeout = claim_timeout
+        self.poll_interval = poll_interval
+        self.local = threading.local()
+        self.puts = 0
+        # Only this user may read or write the cache, SQLite gives the -wal and -shm files the same mode
+        os.close(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600))
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS entries (url TEXT PRIMARY KEY, entry TEXT NOT NULL, accessed REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+            db.execute("CREATE TABLE IF NOT EXISTS inflight (url TEXT PRIMARY KEY, started REAL NOT NULL)")
+
+    def _connect(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+
+    def get(self, url):
+        row = self._connect().execute("SELECT entry FROM entries WHERE url = ?", (url,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, url, entry):
+        db = self._connect()
+        db.execute("INSERT OR REPLACE INTO entries (url, entry, accessed) VALUES (?, ?, ?)",
+                   (url, json.dumps(entry), time.time()))
+        self.puts += 1
+        # Trimming on every write would turn each fetch into a table scan
+        if self.puts % 100 == 0:
+            db.execute("DELETE FROM entries WHERE url NOT IN "
+                       "(SELECT url FROM entries ORDER BY accessed DESC LIMIT ?)", (self.max_entries,))
+
+    def claim(self, url):
+        db = self._connect()
+        now = time.time()
+        db.execute("DELETE FROM inflight WHERE url = ? AND started < ?", (url, now - self.claim_timeout))
+        return db.execute("INSERT OR IGNORE INTO inflight (url, started) VALUES (?, ?)", (url, now)).rowcount == 1
+
+    def release(self, url):
+        self._connect().execute("DELETE FROM inflight WHERE url = ?", (url,))
+
+    def wait(self, url, timeout):
+        db = self._connect()
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if db.execute("SELECT 1 FROM inflight WHERE url = ?", (url,)).fetchone() is None:
+                break
+            time.sleep(self.poll_interval)
+        return self.get(url)
+
+    def clear(self):
+        self._connect().execute("DELETE FROM entries")
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+
+def default_cache_path():
+    """Shared cache file in a directory private to the current user, under XDG_CACHE_HOME or ~/.cache"""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    directory = os.path.join(base, 'playon')
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    if os.stat(directory).st_uid != os.getuid():
+        raise PermissionError(f"{directory} belongs to another user, pass a cache file explicitly")
+    os.chmod(directory, 0o700)
+    return os.path.join(directory, 'upstream_cache.sqlite3')
@@ -0,0 +1,242 @@
+import os
+import sys
+import json
+import time
+import secrets
+import inspect
+import threading
+import functools
+import contextvars
+import urllib.request
+from collections import deque, Counter
+from contextlib import contextmanager
+
+# (trace, parent span id) for whatever request is running in this context, None when not tracing
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class Trace:
+    def __init__(self, name, profiled=False):
+        self.trace_id = secrets.token_hex(16)
+        self.name = name
+        self.profiled = profiled
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def to_otlp(self):
+        """Render the trace as an OTLP/JSON ExportTraceServiceRequest"""
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [_otlp_attribute("service.name", "playon-api")]},
+                "scopeSpans": [{
+                    "scope": {"name": "playon_tracing"},
+                    "spans": [{
+                        "traceId": self.trace_id,
+                        "spanId": span['span_id'],
+                        "parentSpanId": span['parent_id'] or "",
+                        "name": span['name'],
+                        "kind": 2 if span['parent_id'] is None else 1,
+                        "startTimeUnixNano": str(span['start']),
+                        "endTimeUnixNano": str(span['end']),
+                        "attributes": [_otlp_attribute(k, v) for k, v in span['attributes'].items()],
+                        "status": {"code": 2, "message": span['error']} if span['error'] else {},
+                    } for span in self.spans],
+                }],
+            }]
+        }
+
+    def summary(self):
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "spans": [{
+                "name": span['name'],
+                "span_id": span['span_id'],
+                "parent_id": span['parent_id'],
+                "duration_ms": round((span['end'] - span['start']) / 1e6, 2),
+                "attributes": span['attributes'],
+            } for span in self.spans],
+        }
+
+
+def _otlp_attribute(key, value):
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of threads that are inside a span of a profiled request and
+    aggregates them in collapsed-stack format ("outer;inner;leaf count"), which
+    flamegraph.pl and speedscope read directly.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.remaining = 0
+        self.interval = 0.005
+        self.active_threads = Counter()
+        self.stacks = Counter()
+        self.samples = 0
+        self.thread = None
+        # Set while any thread is inside a profiled span, the sampler sleeps on it otherwise
+        self.busy = threading.Event()
+
+    def arm(self, requests, interval_ms=5):
+        with self.lock:
+            self.remaining = requests
+            self.interval = interval_ms / 1000
+            self.stacks.clear()
+            self.samples = 0
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='playon-profiler', daemon=True)
+                self.thread.start()
+
+    def claim_request(self):
+        """Returns True if the request about to start should be profiled"""
+        with self.lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+    def enter(self):
+        with self.lock:
+            self.active_threads[threading.get_ident()] += 1
+            self.busy.set()
+
+    def exit(self):
+        with self.lock:
+            ident = threading.get_ident()
+            self.active_threads[ident] -= 1
+            if self.active_threads[ident] <= 0:
+                del self.active_threads[ident]
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if not self.active_threads:
+                    self.busy.clear()
+            # Parked here between profiled requests instead of waking every interval
+            self.busy.wait()
+            time.sleep(self.interval)
+            with self.lock:
+                idents = list(self.active_threads)
+            if not idents:
+                continue
+            frames = sys._current_frames()
+            collapsed = []
+            for ident in idents:
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if stack:
+                    collapsed.append(';'.join(reversed(stack)))
+            with self.lock:
+                self.stacks.update(collapsed)
+                self.samples += len(collapsed)
+
+    def dump(self):
+        with self.lock:
+            return {
+                "remaining_requests": self.remaining,
+                "interval_ms": self.interval * 1000,
+                "samples": self.samples,
+                "folded": [f"{stack} {count}" for stack, count in self.stacks.most_common()],
+            }
+
+
+profiler = SamplingProfiler()
+recent_traces = deque(maxlen=50)
+# Push finished traces to an OpenTelemetry collector if one is configured
+otlp_endpoint = os.environ.get('OTEL_EXPORTER_OTLP_ENDPOINT')
+
+
+@contextmanager
+def start_trace(name, enabled):
+    """Root span for a request, tracing is skipped unless enabled or the profiler claims it"""
+    profiled = profiler.claim_request()
+    if not (enabled or profiled):
+        yield None
+        return
+    trace = Trace(name, profiled=profiled)
+    try:
+        with span(name, _trace=trace):
+            yield trace
+    finally:
+        recent_traces.append(trace)
+        if otlp_endpoint:
+            threading.Thread(target=export_otlp, args=(trace,), daemon=True).start()
+
+
+@contextmanager
+def span(name, _trace=None, **attributes):
+    """Nested span under the current one, a no-op when the request isn't being traced"""
+    parent = current_trace.get()
+    if parent is None and _trace is None:
+        yield
+        return
+    trace, parent_id = (_trace, None) if _trace is not None else parent
+    record = {'name': name, 'span_id': secrets.token_hex(8), 'parent_id': parent_id,
+              'attributes': attributes, 'error': None, 'start': time.time_ns(), 'end': None}
+    token = current_trace.set((trace, record['span_id']))
+    # Only sample below the root span, the root of an async request sits on the event loop thread
+    sampled = trace.profiled and parent_id is not None
+    if sampled:
+        profiler.enter()
+    try:
+        yield
+    except Exception as e:
+        record['error'] = str(e)
+        raise
+    finally:
+        record['end'] = time.time_ns()
+        if sampled:
+            profiler.exit()
+        current_trace.reset(token)
+        with trace.lock:
+            trace.spans.append(record)
+
+
+def traced(name, *arg_names):
+    """Decorator form of span(), recording the named arguments as span attributes"""
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if current_trace.get() is None:
+                return func(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            attributes = {arg: _attribute_value(bound.arguments[arg]) for arg in arg_names}
+            with span(name, **attributes):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _attribute_value(value):
+    if isinstance(value, dict):
+        return value.get('href') or value.get('name') or str(value)
+    if isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def export_otlp(trace):
+    request = urllib.request.Request(f"{otlp_endpoint.rstrip('/')}/v1/traces",
+                                     data=json.dumps(trace.to_otlp()).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    try:
+        urllib.request.urlopen(request, timeout=5).read()
+    except Exception as e:
+        print(f"Error exporting trace: {e}")
@@ -0,0 +1,262 @@
+import os
+import time
+import heapq
+import hashlib
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import mechanize
+
+from playon_tracing import span
+from playon_store import MemoryStore, SQLiteStore
+
+# Lower number goes first when calls are queued for the PlayOn server
+PRIORITIES = {'interactive': 0, 'rest': 1, 'record': 2, 'background': 3}
+current_priority = contextvars.ContextVar('current_priority', default='rest')
+
+
+@contextmanager
+def upstream_priority(name):
+    """Run the upstream calls made inside the block at the given priority class"""
+    if name not in PRIORITIES:
+        raise ValueError(f"Unknown priority class: {name}")
+    token = current_priority.set(name)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """Seconds until a token is available, 0 if one is available now"""
+        self.refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class UpstreamScheduler:
+    """
+    Every request to a PlayOn server waits here for a slot. At most max_in_flight requests
+    run at once across all hosts and queued requests are let through in priority order
+    (interactive MCP, REST, record, background crawl), first come first served within a class.
+
+    A rate (requests per second per host) adds a token bucket for each host. It is off by
+    default: one search makes dozens of calls, and a rate low enough to matter slows a single
+    client down even with nothing else running. The in-flight cap is what protects the server.
+    """
+
+    def __init__(self, max_in_flight=4, rate=0.0, burst=10):
+        self.max_in_flight = max_in_flight
+        self.rate = rate
+        self.burst = burst
+        self.cond = threading.Condition()
+        self.buckets = {}
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.in_flight = 0
+        self.stats = {name: {'queued': 0, 'started': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0}
+                      for name in PRIORITIES}
+
+    @contextmanager
+    def slot(self, url):
+        host = urlsplit(url).netloc
+        priority = current_priority.get()
+        waiter = (PRIORITIES[priority], next(self.sequence), host)
+        queued_at = time.monotonic()
+        with span('upstream.queue', priority=priority), self.cond:
+            bucket = self.buckets.setdefault(host, TokenBucket(self.rate, self.burst)) if self.rate else None
+            heapq.heappush(self.waiting, waiter)
+            self.stats[priority]['queued'] += 1
+            while True:
+                timeout = self._turn(waiter, bucket)
+                if timeout == 0:
+                    break
+                self.cond.wait(timeout)
+            self.waiting.remove(waiter)
+            heapq.heapify(self.waiting)
+            if bucket is not None:
+                bucket.tokens -= 1
+            self.in_flight += 1
+            waited = time.monotonic() - queued_at
+            stats = self.stats[priority]
+            stats['started'] += 1
+            stats['wait_seconds'] += waited
+            stats['max_wait_seconds'] = max(stats['max_wait_seconds'], waited)
+            # Someone behind us may be for a host that still has tokens
+            self.cond.notify_all()
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.in_flight -= 1
+                self.cond.notify_all()
+
+    def _turn(self, waiter, bucket):
+        """0 if waiter can go now, else how long to wait (None to wait for a notify)"""
+        if self.in_flight >= self.max_in_flight:
+            return None
+        for queued in sorted(self.waiting):
+            queued_bucket = self.buckets.get(queued[2])
+            if queued_bucket is not None and queued_bucket.wait_time() > 0:
+                # Rate limited host, it doesn't hold up other hosts
+                if queued is waiter:
+                    return bucket.wait_time()
+                continue
+            return 0 if queued is waiter else None
+        return None
+
+    def metrics(self):
+        with self.cond:
+            names = {rank: name for name, rank in PRIORITIES.items()}
+            depth = {name: 0 for name in PRIORITIES}
+            for queued in self.waiting:
+                depth[names[queued[0]]] += 1
+            return {
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'queue_depth': depth,
+                'classes': {name: dict(stats) for name, stats in self.stats.items()},
+            }
+
+
+def worker_share(name, default, workers):
+    """This worker's share of a deployment-wide limit from the environment"""
+    total = int(os.environ.get(name, default))
+    # Every worker needs at least one, rounding up would let the workers together go over the limit
+    if total < workers:
+        raise ValueError(f"{name}={total} is lower than the {workers} workers it is split across, "
+                         f"raise it or run fewer workers")
+    return total // workers
+
+
+# The limits are for the whole deployment, so each worker process gets its share of them
+workers = int(os.environ.get('PLAYON_WORKERS', 1))
+upstream_rate = float(os.environ.get('PLAYON_UPSTREAM_RATE', 0))
+scheduler = UpstreamScheduler(
+    max_in_flight=worker_share('PLAYON_UPSTREAM_CONCURRENCY', 4, workers),
+    rate=upstream_rate / workers,
+    burst=worker_share('PLAYON_UPSTREAM_BURST', 10, workers) if upstream_rate else 0,
+)
+
+
+def open_url(br, request):
+    """Open a PlayOn URL (or mechanize.Request) through the scheduler, returns (body, headers)"""
+    url = request.get_full_url() if isinstance(request, mechanize.Request) else request
+    with scheduler.slot(url):
+        response = br.open(request)
+        return response.read(), response.info()
+
+
+class RevalidatingCache:
+    """
+    Remembers the validators (ETag / Last-Modified) and a content hash for every PlayOn URL
+    fetched through it, along with whatever the caller parsed out of the body.
+
+    On the next fetch of the same URL the validators are sent back; a 304, or a 200 whose body
+    hashes the same as last time, returns the previously parsed value without parsing again.
+    PlayOn doesn't always send validators, so the hash is what catches most unchanged listings.
+
+    Concurrent fetches of the same URL are collapsed into one; the others wait for it and reuse
+    its result. With a SQLiteStore this holds across worker processes too.
+    """
+
+    def __init__(self, store=None, wait_timeout=30):
+        self.store = store if store is not None else MemoryStore()
+        self.wait_timeout = wait_timeout
+        self.lock = threading.Lock()
+        self.stats = {'fetched': 0, 'not_modified': 0, 'same_content': 0, 'parsed': 0, 'coalesced': 0}
+
+    def fetch(self, br, url, parse):
+        with span('upstream.fetch', url=url):
+            started = time.time()
+            if not self.store.claim(url):
+                with span('upstream.coalesce', url=url):
+                    entry = self.store.wait(url, self.wait_timeout)
+                if entry is not None and entry['validated'] >= started:
+                    self._count('coalesced')
+                    return _copy(entry['parsed'])
+                # Whoever held the claim failed or took too long, fetch it ourselves
+                if not self.store.claim(url):
+                    return self._fetch(br, url, parse)
+            try:
+                return self._fetch(br, url, parse)
+            finally:
+                self.store.release(url)
+
+    def _fetch(self, br, url, parse):
+        entry = self.store.get(url)
+        request = mechanize.Request(url)
+        if entry is not None:
+            if entry['etag']:
+                request.add_header('If-None-Match', entry['etag'])
+            if entry['last_modified']:
+                request.add_header('If-Modified-Since', entry['last_modified'])
+
+        try:
+            page_source, headers = open_url(br, request)
+        except mechanize.HTTPError as e:
+            if e.code == 304 and entry is not None:
+                self._touch(url, entry, 'not_modified')
+                return _copy(entry['parsed'])
+            raise
+        digest = hashlib.sha1(page_source).hexdigest()
+
+        if entry is not None and entry['digest'] == digest:
+            entry['etag'] = headers.get('ETag') or entry['etag']
+            entry['last_modified'] = headers.get('Last-Modified') or entry['last_modified']
+            self._touch(url, entry, 'same_content')
+            return _copy(entry['parsed'])
+
+        with span('parse', url=url, bytes=len(page_source)):
+            parsed = parse(page_source)
+        entry = {
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'digest': digest,
+            'parsed': parsed,
+        }
+        self._touch(url, entry, 'parsed')
+        return _copy(parsed)
+
+    def _touch(self, url, entry, outcome):
+        entry['validated'] = time.time()
+        self.store.put(url, entry)
+        self._count('fetched')
+        self._count(outcome)
+
+    def _count(self, outcome):
+        with self.lock:
+            self.stats[outcome] += 1
+
+    def clear(self):
+        self.store.clear()
+
+
+def _copy(parsed):
+    # Callers get their own list so appending to a result doesn't change the cached one
+    return list(parsed) if isinstance(parsed, list) else parsed
+
+
+def make_store():
+    """SQLite store when PLAYON_SHARED_CACHE points at a database file, in-memory otherwise"""
+    path = os.environ.get('PLAYON_SHARED_CACHE')
+    if path:
+        return SQLiteStore(path)
+    return MemoryStore()
+
+
+upstream_cache = RevalidatingCache(make_store())
@@ -0,0 +1,43 @@
+import os
+import sys
+import json
+import shutil
+import importlib.util
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from load_test import start_fake_playon  # noqa: E402
+from playon_upstream import upstream_cache  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def playon_server():
+    """Stand-in PlayOn server from the load test, on 127.0.0.1:54479"""
+    server = start_fake_playon("127.0.0.1", 2, 0)
+    yield "127.0.0.1"
+    server.shutdown()
+
+
+@pytest.fixture(scope="session")
+def playon_cli(playon_server, tmp_path_factory):
+    """
+    playon_api imported from a copy next to a config.json for the stand-in server,
+    since the CLI reads its config from beside the script at import time
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    cli_dir = tmp_path_factory.mktemp("cli")
+    shutil.copy(os.path.join(root, "playon_api.py"), cli_dir)
+    (cli_dir / "config.json").write_text(json.dumps(
+        {"server": {"ip": playon_server, "port": 54479, "base_url": "http://{ip}:{port}"}}))
+    spec = importlib.util.spec_from_file_location("playon_api", cli_dir / "playon_api.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(autouse=True)
+def empty_upstream_cache():
+    upstream_cache.clear()
+    yield
@@ -0,0 +1,50 @@
+import io
+import json
+
+
+class ClosedPipe(io.StringIO):
+    def write(self, text):
+        raise BrokenPipeError()
+
+
+def expected_matches(cli, search_term, media_type, excluded=()):
+    providers = cli.get_providers()
+    return {
+        (search_term, name, result['href'])
+        for name, info in providers.items() if name not in excluded
+        for result in cli.filter_results(cli.query_provider(info['id'], search_term), search_term, media_type,
+                                         'partial')
+    }
+
+
+def test_batch_search_writes_every_match_as_a_json_line(playon_cli, capsys):
+    out, log = io.StringIO(), io.StringIO()
+
+    total = playon_cli.batch_search(["Bluey", "Columbo"], "movie", "partial", [], 4, out, log)
+
+    lines = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert total == len(lines) > 0
+    assert {(line['search_term'], line['provider_name'], line['href']) for line in lines} == \
+        expected_matches(playon_cli, "Bluey", "movie") | expected_matches(playon_cli, "Columbo", "movie")
+    assert "[2/2]" in log.getvalue()
+
+
+def test_batch_search_skips_excluded_providers(playon_cli, capsys):
+    out = io.StringIO()
+
+    playon_cli.batch_search(["Bluey"], "movie", "partial", ["Provider 0"], 2, out, io.StringIO())
+
+    providers = {json.loads(line)['provider_name'] for line in out.getvalue().splitlines()}
+    assert providers == {"Provider 1"}
+
+
+def test_batch_search_stops_when_the_reader_goes_away(playon_cli, capsys):
+    total = playon_cli.batch_search(["Bluey", "Columbo", "Nova"], "movie", "partial", [], 4, ClosedPipe(), io.StringIO())
+
+    assert total == 0
+
+
+def test_match_pattern_treats_titles_literally(playon_cli):
+    assert playon_cli.match_pattern("C++").match("Learn C++ Now")
+    assert playon_cli.match_pattern("Who?", "exact").match("WHO?")
+    assert not playon_cli.match_pattern("Who?", "exact").match("Wh")
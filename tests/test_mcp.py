@@ -0,0 +1,144 @@
+import sys
+import threading
+
+from fastapi.testclient import TestClient
+
+import playon_api_and_mcp as mcp
+from playon_upstream import upstream_cache
+
+
+def rpc(method, params=None):
+    return {"jsonrpc": "2.0", "id": 1, "method": method, "params": params or {}}
+
+
+def tool_text(response):
+    return response.json()["result"]["content"][0]["text"]
+
+
+def make_cursor(names, format_item=lambda item: item["name"]):
+    return mcp.ResultCursor("search_media", header=lambda count: f"Found {count} results",
+                            title="Results", items=iter({"name": name} for name in names),
+                            format_item=format_item)
+
+
+def test_cursor_pages_by_limit():
+    cursor = make_cursor(["a", "b", "c", "d", "e"])
+
+    assert cursor.next_page(2, 1000) == (["a", "b"], False)
+    assert cursor.next_page(2, 1000) == (["c", "d"], False)
+    assert cursor.next_page(2, 1000) == (["e"], True)
+
+
+def test_cursor_exact_limit_ends_on_the_following_call():
+    cursor = make_cursor(["a", "b", "c", "d"])
+
+    first = cursor.page(2, 1000)["content"][0]["text"]
+    assert f'cursor "{cursor.id}"' in first
+    assert cursor.id in mcp.cursors
+
+    # The last two fill the page, whether anything follows isn't known until it's asked for
+    second = cursor.page(2, 1000)["content"][0]["text"]
+    assert second.startswith("Results (3-4):\n\nc\nd\n\nMore results available")
+
+    last = cursor.page(2, 1000)["content"][0]["text"]
+    assert last == "Results: no more results.\n\nEnd of results."
+    assert cursor.id not in mcp.cursors
+
+
+def test_cursor_does_not_pull_items_for_the_next_page():
+    pulled = []
+
+    def items():
+        for name in ["a", "b", "c"]:
+            pulled.append(name)
+            yield {"name": name}
+
+    cursor = mcp.ResultCursor("search_media", header=lambda count: f"Found {count} results",
+                              title="Results", items=items(), format_item=lambda item: item["name"])
+
+    assert cursor.next_page(2, 1000) == (["a", "b"], False)
+    assert pulled == ["a", "b"]
+
+
+def test_cursor_byte_budget_carries_pending_line():
+    # Each line costs its length plus a newline
+    cursor = make_cursor(["aaaa", "bbbb", "cccc", "dddddddddd"])
+
+    assert cursor.next_page(10, 10) == (["aaaa", "bbbb"], False)
+    assert cursor.pending == "cccc"
+    # The held line goes first, and a line over budget on its own is still sent
+    assert cursor.next_page(10, 10) == (["cccc"], False)
+    assert cursor.pending == "dddddddddd"
+    assert cursor.next_page(10, 10) == (["dddddddddd"], True)
+    assert cursor.pending is None
+
+
+def test_search_media_continues_from_cursor(playon_server):
+    with TestClient(mcp.app) as client:
+        arguments = {"search_term": "Bluey", "server": playon_server}
+        full = tool_text(client.post("/mcp", json=rpc("tools/call", {"name": "search_media", "arguments": arguments})))
+        expected = [line for line in full.splitlines() if line.startswith("• ")]
+        assert len(expected) > 1
+
+        seen = []
+        response = client.post("/mcp", json=rpc("tools/call", {
+            "name": "search_media", "arguments": dict(arguments, limit=1)}))
+        while True:
+            text = tool_text(response)
+            seen.extend(line for line in text.splitlines() if line.startswith("• "))
+            if "End of results." in text:
+                break
+            cursor_id = text.rsplit('cursor "', 1)[1].split('"')[0]
+            response = client.post("/mcp", json=rpc("tools/call", {
+                "name": "search_media", "arguments": {"cursor": cursor_id, "limit": 1}}))
+
+    assert seen == expected
+
+
+def test_paged_folder_trace_warms_the_session(playon_server):
+    session = mcp.MCPSession()
+    token = mcp.current_session.set(session)
+    try:
+        folder = {"href": "/data/data.xml?id=p0-s1-1", "name": "Show"}
+        items = list(mcp.iter_trace_folder(folder, playon_server))
+        fetched = upstream_cache.stats["fetched"]
+
+        assert len(items) == 24
+        assert session.recall(session.folders, f"{playon_server}{folder['href']}") == items
+        assert mcp.trace_folder(folder, playon_server) == items
+        assert upstream_cache.stats["fetched"] == fetched
+    finally:
+        mcp.current_session.reset(token)
+
+
+def test_cursor_table_survives_concurrent_tool_threads(monkeypatch):
+    # A big table makes the idle sweep in store_cursor slow enough for threads to collide in it
+    monkeypatch.setattr(mcp, "MAX_CURSORS", 5000)
+    switch_interval = sys.getswitchinterval()
+    # Switch threads as often as possible so they interleave inside the table updates
+    sys.setswitchinterval(1e-6)
+    errors = []
+
+    def churn():
+        try:
+            for n in range(1000):
+                cursor = make_cursor(["a"])
+                mcp.store_cursor(cursor)
+                mcp.take_cursor(cursor.id, "search_media")
+                if n % 2:
+                    mcp.drop_cursor(cursor.id)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=churn) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+
+    assert errors == []
+    assert len(mcp.cursors) <= mcp.MAX_CURSORS
+    mcp.cursors.clear()
@@ -0,0 +1,47 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import playon_api_and_mcp as mcp
+
+
+@pytest.fixture
+def client():
+    with TestClient(mcp.app) as client:
+        yield client
+
+
+@pytest.mark.parametrize("path, params", [
+    ("/providers", {}),
+    ("/search", {"search_term": "Doctor Who", "media_type": "movie"}),
+])
+def test_etag_revalidation_answers_304(client, playon_server, path, params):
+    params = dict(params, server=playon_server)
+    first = client.get(path, params=params)
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+    assert first.headers["cache-control"].startswith("private, max-age=")
+
+    again = client.get(path, params=params, headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.content == b""
+    assert again.headers["etag"] == etag
+
+    assert client.get(path, params=params, headers={"If-None-Match": 'W/"stale"'}).status_code == 200
+
+
+def test_etag_changes_with_the_results(client, playon_server):
+    bluey = client.get("/search", params={"search_term": "Bluey", "media_type": "movie", "server": playon_server})
+    columbo = client.get("/search", params={"search_term": "Columbo", "media_type": "movie", "server": playon_server})
+
+    assert bluey.headers["etag"] != columbo.headers["etag"]
+
+
+def test_large_responses_are_gzipped_with_a_single_vary(client, monkeypatch):
+    providers = {f"Provider {n}": {"href": f"/data/data.xml?id=p{n}", "id": f"p{n}"} for n in range(100)}
+    monkeypatch.setattr(mcp, "get_providers", lambda server: providers)
+
+    response = client.get("/providers", headers={"Accept-Encoding": "gzip"})
+
+    assert response.json() == providers
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
@@ -0,0 +1,76 @@
+import os
+import stat
+import time
+import multiprocessing
+
+from playon_store import SQLiteStore, default_cache_path
+
+URL = "http://playon:54479/data/data.xml"
+ENTRY = {'etag': None, 'last_modified': None, 'digest': 'abc', 'parsed': ['Bluey'], 'validated': 1.0}
+
+fork = multiprocessing.get_context('fork')
+
+
+def fetch_in_other_worker(path, claimed, hold):
+    store = SQLiteStore(path)
+    assert store.claim(URL)
+    claimed.set()
+    time.sleep(hold)
+    store.put(URL, ENTRY)
+    store.release(URL)
+
+
+def claim_and_die(path):
+    SQLiteStore(path).claim(URL)
+    os._exit(0)
+
+
+def test_claims_are_shared_between_processes(tmp_path):
+    path = tmp_path / "cache.sqlite3"
+    store = SQLiteStore(path)
+    claimed = fork.Event()
+    worker = fork.Process(target=fetch_in_other_worker, args=(str(path), claimed, 0.3))
+    worker.start()
+    try:
+        assert claimed.wait(5)
+        assert not store.claim(URL)
+
+        started = time.monotonic()
+        assert store.wait(URL, 5) == ENTRY
+        assert time.monotonic() - started < 4
+        assert store.claim(URL)
+    finally:
+        worker.join()
+    assert worker.exitcode == 0
+
+
+def test_claim_left_by_a_dead_worker_expires(tmp_path):
+    path = tmp_path / "cache.sqlite3"
+    store = SQLiteStore(path, claim_timeout=0.2)
+    worker = fork.Process(target=claim_and_die, args=(str(path),))
+    worker.start()
+    worker.join()
+
+    assert not store.claim(URL)
+    time.sleep(0.3)
+    assert store.claim(URL)
+
+
+def test_entries_round_trip_and_clear(tmp_path):
+    store = SQLiteStore(tmp_path / "cache.sqlite3")
+    store.put(URL, ENTRY)
+
+    assert SQLiteStore(tmp_path / "cache.sqlite3").get(URL) == ENTRY
+    assert len(store) == 1
+    store.clear()
+    assert store.get(URL) is None
+
+
+def test_cache_files_are_private_to_the_user(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+
+    path = default_cache_path()
+    SQLiteStore(path)
+
+    assert stat.S_IMODE(os.stat(os.path.dirname(path)).st_mode) == 0o700
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
@@ -0,0 +1,85 @@
+import time
+
+from fastapi.testclient import TestClient
+
+import playon_api_and_mcp as mcp
+from load_test import FakePlayOnHandler
+from playon_tracing import profiler, start_trace, traced
+
+
+def rpc(method, params=None):
+    return {"jsonrpc": "2.0", "id": 1, "method": method, "params": params or {}}
+
+
+def tool_text(response):
+    return response.json()["result"]["content"][0]["text"]
+
+
+def test_traced_search_media(playon_server):
+    with TestClient(mcp.app) as client:
+        response = client.post("/mcp", headers={"X-Trace": "1"}, json=rpc("tools/call", {
+            "name": "search_media", "arguments": {"search_term": "Bluey", "server": playon_server}}))
+        assert response.status_code == 200
+        assert not response.json()["result"]["isError"]
+        assert tool_text(response).startswith("Found ")
+
+        trace_id = response.headers["X-Trace-Id"]
+        traces = client.get("/debug/traces", params={"trace_id": trace_id}).json()
+
+    assert len(traces) == 1
+    spans = {span["span_id"]: span for span in traces[0]["spans"]}
+    names = {span["name"] for span in spans.values()}
+    assert {"POST /mcp", "get_providers", "query_provider", "upstream.fetch", "upstream.queue"} <= names
+
+    # Spans recorded in the tool's worker thread still hang off the request's root span
+    root = next(span for span in spans.values() if span["parent_id"] is None)
+    assert root["name"] == "POST /mcp"
+    for span in spans.values():
+        if span["name"] == "query_provider":
+            assert span["parent_id"] == root["span_id"]
+            assert span["attributes"]["search_term"] == "Bluey"
+
+
+def test_requests_are_not_traced_unless_asked(playon_server):
+    with TestClient(mcp.app) as client:
+        response = client.get("/providers", params={"server": playon_server})
+
+    assert "x-trace-id" not in response.headers
+
+
+def test_traced_decorator_records_arguments_and_errors():
+    @traced("lookup", "search_term")
+    def lookup(search_term, provider):
+        raise ValueError("no such provider")
+
+    with start_trace("test", enabled=True) as trace:
+        try:
+            lookup("Bluey", "p9")
+        except ValueError:
+            pass
+
+    spans = {span["name"]: span for span in trace.summary()["spans"]}
+    assert spans["lookup"]["attributes"] == {"search_term": "Bluey"}
+    assert spans["lookup"]["parent_id"] == spans["test"]["span_id"]
+    otlp = trace.to_otlp()["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    assert next(span for span in otlp if span["name"] == "lookup")["status"] == {"code": 2, "message": "no such provider"}
+
+
+def test_profiler_samples_armed_requests_then_parks(playon_server, monkeypatch):
+    monkeypatch.setattr(FakePlayOnHandler, "latency", 0.05)
+    with TestClient(mcp.app) as client:
+        client.post("/debug/profile", params={"requests": 1, "interval_ms": 1})
+        client.get("/search", params={"search_term": "Bluey", "server": playon_server})
+        dump = client.get("/debug/profile").json()
+        folded = client.get("/debug/profile", params={"format": "folded"}).text
+
+    assert dump["remaining_requests"] == 0
+    assert dump["samples"] > 0
+    assert "query_provider" in folded
+
+    # Nothing profiled is running, so the sampler thread is parked rather than polling
+    time.sleep(0.05)
+    assert not profiler.busy.is_set()
+    samples = profiler.dump()["samples"]
+    time.sleep(0.05)
+    assert profiler.dump()["samples"] == samples
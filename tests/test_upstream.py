@@ -0,0 +1,202 @@
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import mechanize
+import pytest
+
+from load_test import FakePlayOnHandler
+from playon_store import MemoryStore
+from playon_upstream import UpstreamScheduler, RevalidatingCache, upstream_priority, worker_share
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def test_scheduler_lets_queued_requests_through_in_priority_order():
+    scheduler = UpstreamScheduler(max_in_flight=1)
+    order = []
+
+    def request(priority):
+        with upstream_priority(priority), scheduler.slot("http://playon:54479/data/data.xml"):
+            order.append(priority)
+
+    threads = []
+    with scheduler.slot("http://playon:54479/data/data.xml"):
+        # Queue them lowest priority first, one at a time so arrival order is known
+        for priority in ["background", "record", "rest", "interactive", "rest"]:
+            queued = sum(scheduler.metrics()["queue_depth"].values())
+            thread = threading.Thread(target=request, args=(priority,))
+            thread.start()
+            threads.append(thread)
+            wait_for(lambda: sum(scheduler.metrics()["queue_depth"].values()) == queued + 1)
+    for thread in threads:
+        thread.join()
+
+    assert order == ["interactive", "rest", "rest", "record", "background"]
+    assert scheduler.metrics()["classes"]["interactive"]["started"] == 1
+
+
+def test_scheduler_caps_requests_in_flight():
+    scheduler = UpstreamScheduler(max_in_flight=2)
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def request():
+        with scheduler.slot("http://playon:54479/data/data.xml"):
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.02)
+            with lock:
+                running.pop()
+
+    threads = [threading.Thread(target=request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(peak) == 2
+
+
+def test_scheduler_does_not_rate_limit_by_default():
+    scheduler = UpstreamScheduler()
+    started = time.monotonic()
+    for _ in range(50):
+        with scheduler.slot("http://playon:54479/data/data.xml"):
+            pass
+
+    assert time.monotonic() - started < 0.5
+    assert scheduler.buckets == {}
+
+
+def test_scheduler_rate_limits_each_host_when_configured():
+    scheduler = UpstreamScheduler(max_in_flight=4, rate=20, burst=2)
+    started = time.monotonic()
+    for _ in range(4):
+        with scheduler.slot("http://slow:54479/data/data.xml"):
+            pass
+    # Two come out of the burst, the other two wait 1/20s each for a token
+    assert time.monotonic() - started >= 0.09
+
+    started = time.monotonic()
+    with scheduler.slot("http://other:54479/data/data.xml"):
+        pass
+    assert time.monotonic() - started < 0.05
+
+
+class CountingParse:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, page_source):
+        self.calls += 1
+        return [page_source.decode('utf-8')]
+
+
+class ETagHandler(BaseHTTPRequestHandler):
+    body = b'<catalog><group name="Bluey"/></catalog>'
+    etag = '"v1"'
+
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def browser():
+    br = mechanize.Browser()
+    br.set_handle_robots(False)
+    return br
+
+
+def test_cache_skips_parsing_an_unchanged_body(playon_server, browser):
+    cache = RevalidatingCache(MemoryStore())
+    parse = CountingParse()
+    url = f"http://{playon_server}:54479/data/data.xml"
+
+    first = cache.fetch(browser, url, parse)
+    second = cache.fetch(browser, url, parse)
+
+    assert first == second
+    assert parse.calls == 1
+    assert cache.stats['fetched'] == 2
+    assert cache.stats['same_content'] == 1
+
+
+def test_cache_reuses_the_parse_on_304():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ETagHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        br = mechanize.Browser()
+        br.set_handle_robots(False)
+        cache = RevalidatingCache(MemoryStore())
+        parse = CountingParse()
+        url = f"http://127.0.0.1:{server.server_port}/data/data.xml"
+
+        first = cache.fetch(br, url, parse)
+        second = cache.fetch(br, url, parse)
+    finally:
+        server.shutdown()
+
+    assert first == second
+    assert parse.calls == 1
+    assert cache.stats['not_modified'] == 1
+
+
+def test_cache_hands_out_copies_of_lists(playon_server, browser):
+    cache = RevalidatingCache(MemoryStore())
+    url = f"http://{playon_server}:54479/data/data.xml"
+
+    cache.fetch(browser, url, CountingParse()).append("changed")
+
+    assert "changed" not in cache.fetch(browser, url, CountingParse())
+
+
+def test_cache_collapses_concurrent_fetches_of_one_url(playon_server, monkeypatch):
+    monkeypatch.setattr(FakePlayOnHandler, "latency", 0.2)
+    cache = RevalidatingCache(MemoryStore())
+    parse = CountingParse()
+    url = f"http://{playon_server}:54479/data/data.xml?id=p0"
+    results = []
+
+    def fetch():
+        br = mechanize.Browser()
+        br.set_handle_robots(False)
+        results.append(cache.fetch(br, url, parse))
+
+    threads = [threading.Thread(target=fetch) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 6 and all(result == results[0] for result in results)
+    assert parse.calls == 1
+    assert cache.stats['fetched'] == 1
+    assert cache.stats['coalesced'] == 5
+
+
+def test_worker_share_splits_limits_without_exceeding_them(monkeypatch):
+    monkeypatch.setenv("PLAYON_UPSTREAM_CONCURRENCY", "8")
+    assert worker_share("PLAYON_UPSTREAM_CONCURRENCY", 4, 3) == 2
+
+    monkeypatch.setenv("PLAYON_UPSTREAM_CONCURRENCY", "2")
+    with pytest.raises(ValueError):
+        worker_share("PLAYON_UPSTREAM_CONCURRENCY", 4, 3)
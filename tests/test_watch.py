@@ -0,0 +1,109 @@
+def new_state():
+    return {'terms': {}, 'series': {}}
+
+
+def queued_hrefs(report):
+    return {item['href'] for item in report['queued']}
+
+
+def test_first_cycle_queues_everything_and_the_next_only_what_is_new(playon_cli, capsys):
+    state = new_state()
+
+    first = playon_cli.watch_cycle(["Bluey"], state, budget=1000)
+    assert first['searched'] == 1 and first['discovered'] > 0
+    assert first['errors'] == [] and first['deferred'] == 0
+    series = state['terms']['Bluey']['series']
+    assert len(first['queued']) == sum(len(state['series'][key]['seen']) for key in series) > 0
+
+    second = playon_cli.watch_cycle(["Bluey"], state, budget=1000)
+    assert second['checked'] == len(series)
+    assert second['queued'] == []
+
+    # Episodes that weren't seen before are the only ones queued
+    key = series[0]
+    missing = set(state['series'][key]['seen'][:2])
+    state['series'][key]['seen'] = state['series'][key]['seen'][2:]
+    third = playon_cli.watch_cycle(["Bluey"], state, budget=1000)
+    assert queued_hrefs(third) == missing
+
+
+def test_skip_existing_marks_a_new_series_as_seen(playon_cli, capsys):
+    state = new_state()
+
+    report = playon_cli.watch_cycle(["Bluey"], state, budget=1000, skip_existing=True)
+
+    assert report['queued'] == []
+    assert all(state['series'][key]['seen'] for key in state['terms']['Bluey']['series'])
+
+
+def test_budget_defers_work_to_later_cycles(playon_cli, capsys):
+    unlimited = playon_cli.watch_cycle(["Bluey", "Columbo"], new_state(), budget=1000)
+    # One provider's search (a query plus tracing its matches) is the most a cycle can overshoot by
+    overshoot = 16
+
+    state = new_state()
+    queued = set()
+    deferred = 0
+    # Every watched series is re-checked each cycle, so a small budget always leaves some for next time
+    for _ in range(50):
+        report = playon_cli.watch_cycle(["Bluey", "Columbo"], state, budget=10)
+        assert report['errors'] == []
+        assert report['requests'] <= 10 + overshoot
+        assert not queued & queued_hrefs(report)
+        queued |= queued_hrefs(report)
+        deferred += report['deferred']
+        if queued == queued_hrefs(unlimited):
+            break
+    else:
+        raise AssertionError("not everything got queued in 50 cycles")
+
+    assert deferred > 0
+    assert all('searched_providers' not in entry for entry in state['terms'].values())
+
+
+def test_interrupted_discovery_resumes_from_the_next_provider(playon_cli, capsys):
+    state = new_state()
+
+    report = playon_cli.watch_cycle(["Bluey"], state, budget=1)
+
+    entry = state['terms']['Bluey']
+    assert report['searched'] == 0 and report['deferred'] >= 1
+    assert entry['last_discovered'] == 0
+    assert entry['searched_providers'] == ["Provider 0"]
+
+    report = playon_cli.watch_cycle(["Bluey"], state, budget=1)
+    assert report['searched'] == 1
+    assert state['terms']['Bluey']['last_discovered'] > 0
+    assert 'searched_providers' not in state['terms']['Bluey']
+
+
+def test_empty_series_folder_is_not_queued(playon_cli, monkeypatch, capsys):
+    key = "/data/data.xml?id=p0-s1-1"
+    state = {'terms': {'Empty': {'series': [key], 'last_discovered': 2 ** 40}},
+             'series': {key: {'name': 'Empty', 'provider': 'p0', 'type': 'folder', 'seen': [], 'last_checked': 0}}}
+    # trace_folder hands back the folder itself when it has nothing in it
+    monkeypatch.setattr(playon_cli, "trace_folder", lambda result, server=None: [result])
+
+    report = playon_cli.watch_cycle(["Empty"], state, budget=1000)
+
+    assert report['checked'] == 1
+    assert report['queued'] == []
+    assert state['series'][key]['seen'] == []
+
+
+def test_a_failing_job_is_reported_and_the_cycle_carries_on(playon_cli, monkeypatch, capsys):
+    state = new_state()
+    playon_cli.watch_cycle(["Bluey"], state, budget=1000)
+    broken, *working = state['terms']['Bluey']['series']
+    trace_folder = playon_cli.trace_folder
+
+    def flaky_trace_folder(result, server=None):
+        if result['href'] == broken:
+            raise RuntimeError("PlayOn went away")
+        return trace_folder(result, server)
+    monkeypatch.setattr(playon_cli, "trace_folder", flaky_trace_folder)
+
+    report = playon_cli.watch_cycle(["Bluey"], state, budget=1000)
+
+    assert report['errors'] == [{'check': broken, 'error': "PlayOn went away"}]
+    assert report['checked'] == len(working)